@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of a full one-shot collection cycle, as run by
+Session.cycle(), against local stand-ins for QuasarDB and CloudWatch:
+
+    python -m benchmarks.bench_exporter --nodes 1,4,16 --keys 50,200,1000
+
+Pass --save to record the results and --compare to fail when a later run
+regresses beyond --tolerance.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from qdb_cloudwatch import exporter
+from qdb_cloudwatch.exporter import Session
+
+from .fakes import FakeCloudWatch
+from .fakes import FakeCluster
+
+# Results compared against a baseline; all of them are "lower is better".
+COMPARED = ['cycle_s', 'round_trips', 'api_calls', 'peak_kib']
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark qdb-cloudwatch collection cycles offline.')
+    parser.add_argument('--nodes', default='1,4,16',
+                        help='Comma separated node counts. Defaults to 1,4,16.')
+    parser.add_argument('--keys', default='50,200,1000',
+                        help='Comma separated statistic counts per node. Defaults to 50,200,1000.')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='Seconds slept per QuasarDB round trip. Defaults to 0.0005.')
+    parser.add_argument('--api-latency', dest='api_latency', type=float, default=0.005,
+                        help='Seconds slept per put_metric_data call. Defaults to 0.005.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Statistics fetched concurrently per node. Defaults to 8.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Cycles per scenario; the fastest is reported. Defaults to 3.')
+    parser.add_argument('--save', help='Write results as JSON to this file.')
+    parser.add_argument('--compare', help='Compare against results previously written with --save.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative regression allowed by --compare. Defaults to 0.2.')
+    return parser.parse_args()
+
+def session_args(conn, state_dir, args):
+    argv = ['--cluster', 'qdb://benchmark',
+            '--namespace', 'Benchmark',
+            '--no-instance-id',
+            '--no-self-metrics',
+            '--spool-max-bytes', '0',
+            '--concurrency', str(args.concurrency),
+            '--state-dir', state_dir]
+
+    if len(conn.node_ids) > 1:
+        argv.append('--all-nodes')
+    else:
+        argv.extend(['--node-id', conn.node_ids[0]])
+
+    return exporter.get_args(argv)
+
+def run_cycle(conn, client, session_args):
+    # The session connects through these; hand it the stand-ins instead.
+    (get_qdb_conn, get_cloudwatch_client) = (exporter.get_qdb_conn, exporter.get_cloudwatch_client)
+    exporter.get_qdb_conn = lambda uri: conn
+    exporter.get_cloudwatch_client = lambda region_name=None, aws_client=None: client
+
+    session = Session(session_args)
+    try:
+        return session.cycle()
+    finally:
+        session.close()
+        (exporter.get_qdb_conn, exporter.get_cloudwatch_client) = (get_qdb_conn, get_cloudwatch_client)
+
+def run_scenario(nodes, keys, args):
+    best = None
+    for _ in range(args.repeat):
+        conn = FakeCluster(nodes, keys, args.latency)
+        client = FakeCloudWatch(args.api_latency)
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            cycle_args = session_args(conn, state_dir, args)
+
+            # A previous run leaves the key index and counter values behind;
+            # measure the run that follows it.
+            run_cycle(conn, client, cycle_args)
+            conn.round_trips = 0
+            client.calls = []
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            run_cycle(conn, client, cycle_args)
+            elapsed = time.perf_counter() - start
+            (_, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        result = {'nodes': nodes,
+                  'keys': keys,
+                  'cycle_s': elapsed,
+                  'round_trips': conn.round_trips,
+                  'api_calls': len(client.calls),
+                  'datums': client.datums,
+                  'peak_kib': peak / 1024.0}
+
+        if best is None or result['cycle_s'] < best['cycle_s']:
+            best = result
+
+    return best
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    previous = dict(((x['nodes'], x['keys']), x) for x in baseline)
+
+    for x in results:
+        y = previous.get((x['nodes'], x['keys']))
+        if y is None:
+            continue
+
+        for k in COMPARED:
+            if x[k] > y[k] * (1 + tolerance):
+                regressions.append("{} nodes x {} keys: {} {:.4g} -> {:.4g}"
+                                   .format(x['nodes'], x['keys'], k, y[k], x[k]))
+
+    return regressions
+
+def main():
+    args = get_args()
+
+    results = []
+    print("{:>6} {:>6} {:>10} {:>12} {:>10} {:>8} {:>10}"
+          .format('nodes', 'keys', 'cycle_s', 'round_trips', 'api_calls', 'datums', 'peak_kib'))
+
+    for nodes in [int(x) for x in args.nodes.split(',')]:
+        for keys in [int(x) for x in args.keys.split(',')]:
+            x = run_scenario(nodes, keys, args)
+            results.append(x)
+            print("{nodes:>6} {keys:>6} {cycle_s:>10.4f} {round_trips:>12} {api_calls:>10} {datums:>8} {peak_kib:>10.1f}"
+                  .format(**x))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for x in regressions:
+            print("regression: ", x, file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
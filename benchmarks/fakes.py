@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from qdb_cloudwatch.keyindex import STATISTICS_PREFIX
+
+# A representative mix of the statistics a node exposes; perf timings are
+# generated on top of these to reach the requested key count.
+BASE_STATISTICS = {'cpu.idle': 1000000,
+                   'cpu.system': 20000,
+                   'cpu.user': 50000,
+                   'disk.bytes_free': 1 << 30,
+                   'disk.bytes_total': 1 << 32,
+                   'disk.path': b'/var/lib/qdb',
+                   'engine_version': b'3.3.1',
+                   'hardware_concurrency': 16,
+                   'memory.physmem.bytes_total': 1 << 34,
+                   'memory.physmem.bytes_used': 1 << 33,
+                   'network.sessions.max_count': 512,
+                   'persistence.bytes_capacity': 1 << 32,
+                   'persistence.bytes_utilized': 1 << 31,
+                   'requests.total_count': 1000,
+                   'startup': 1}
+
+def node_statistics(node_id, key_count):
+    stats = dict()
+    for (k, v) in BASE_STATISTICS.items():
+        stats[STATISTICS_PREFIX + node_id + '.' + k] = v
+
+    i = 0
+    while len(stats) < key_count:
+        k = 'perf.bench.op_{}.stage_{}.total_ns'.format(i // 8, i % 8)
+        stats[STATISTICS_PREFIX + node_id + '.' + k] = i * 1000
+        i += 1
+
+    return stats
+
+class _Entry(object):
+    def __init__(self, cluster, key):
+        self.cluster = cluster
+        self.key = key
+
+    def get(self):
+        self.cluster.round_trip()
+        return self.cluster.statistics[self.key]
+
+class FakeCluster(object):
+    """
+    Stand-in for quasardb.Cluster serving `node_count` nodes of `key_count`
+    statistics each. Every call that would hit the network sleeps `latency`
+    seconds and is counted as a round trip.
+    """
+
+    def __init__(self, node_count=1, key_count=200, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+        self.node_ids = ['0-0-0-{}'.format(i + 1) for i in range(node_count)]
+        self.statistics = dict()
+        for node_id in self.node_ids:
+            self.statistics.update(node_statistics(node_id, key_count))
+
+        self._sorted = sorted(self.statistics)
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def prefix_get(self, prefix, max_count):
+        self.round_trip()
+        return [k for k in self._sorted if k.startswith(prefix)][:max_count]
+
+    def prefix_count(self, prefix):
+        self.round_trip()
+        return sum(1 for k in self._sorted if k.startswith(prefix))
+
+    def integer(self, key):
+        return _Entry(self, key)
+
+    def blob(self, key):
+        return _Entry(self, key)
+
+class FakeCloudWatch(object):
+    """
+    Stand-in for a boto3 CloudWatch client recording each put_metric_data
+    call.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def put_metric_data(self, Namespace, MetricData):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.calls.append((Namespace, len(MetricData)))
+
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    @property
+    def datums(self):
+        return sum(n for (_, n) in self.calls)
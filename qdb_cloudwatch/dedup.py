@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from .metrics import MetricType
+from .state import load_state
+from .state import save_state
+
+def is_gauge(metric):
+    return metric['type'].value is MetricType.GAUGE.value
+
+class ChangeFilter(object):
+    """
+    Suppresses gauges whose value did not change, or changed by at most
+    `tolerance` relative to the last published value, since they were last
+    published. A gauge is always republished once `heartbeat` seconds have
+    passed so alarms on it never run out of data.
+    """
+
+    def __init__(self, heartbeat, tolerance=0.0, path=None):
+        self.heartbeat = heartbeat
+        self.tolerance = tolerance
+        self.path = path
+        self._nodes = load_state(path) or dict()
+
+    def _unchanged(self, x, last):
+        if self.tolerance <= 0:
+            return x == last
+        return abs(x - last) <= self.tolerance * abs(last)
+
+    def filter(self, node_id, metrics, now=None):
+        if now is None:
+            now = time.time()
+
+        published = self._nodes.setdefault(node_id, dict())
+
+        res = dict()
+        for (k, metric) in metrics.items():
+            # Aggregated samples carry no single value to compare.
+            if not is_gauge(metric) or 'value' not in metric or 'statistics' in metric or 'values' in metric:
+                res[k] = metric
+                continue
+
+            x = metric['value']
+            last = published.get(k)
+            if last is not None and now - last[1] < self.heartbeat and self._unchanged(x, last[0]):
+                continue
+
+            published[k] = [x, now]
+            res[k] = metric
+
+        return res
+
+    def save(self):
+        save_state(self.path, self._nodes)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import math
+import re
+
+from .metrics import MetricType
+from .metrics import pattern_to_regex
+
+class Derived(object):
+    """
+    A metric computed from collected ones. `fn` receives one array per
+    input, holding that input's value on every node, and returns the derived
+    values as an array. Inputs are statistic names or patterns; a pattern
+    input is the sum of all statistics it matches.
+    """
+
+    __slots__ = ('name', 'unit', 'inputs', 'fn')
+
+    def __init__(self, name, unit, inputs, fn):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'unit', unit)
+        object.__setattr__(self, 'inputs', tuple(inputs))
+        object.__setattr__(self, 'fn', fn)
+
+    def __setattr__(self, k, v):
+        raise AttributeError("Derived descriptors are immutable")
+
+def _percent(part, whole):
+    return 100.0 * part / whole
+
+# Counters are converted to rates or deltas before these are evaluated, so
+# ratios of counters are over the last interval rather than since startup.
+DERIVED = (Derived('cpu.utilization', 'Percent',
+                   ['cpu.idle', 'cpu.system', 'cpu.user'],
+                   lambda idle, system, user: _percent(system + user, idle + system + user)),
+           Derived('disk.utilization', 'Percent',
+                   ['disk.bytes_free', 'disk.bytes_total'],
+                   lambda free, total: _percent(total - free, total)),
+           Derived('memory.physmem.utilization', 'Percent',
+                   ['memory.physmem.bytes_used', 'memory.physmem.bytes_total'],
+                   _percent),
+           Derived('persistence.utilization', 'Percent',
+                   ['persistence.bytes_utilized', 'persistence.bytes_capacity'],
+                   _percent),
+           Derived('requests.error_rate', 'Percent',
+                   ['requests.errors_count', 'requests.total_count'],
+                   _percent),
+           Derived('requests.latency.average', 'Microseconds',
+                   ['perf.*.*.processing.total_ns', 'requests.total_count'],
+                   lambda processing, requests: processing / requests))
+
+_regexes = dict()
+
+def _input(metrics, name):
+    """
+    Returns the value of input `name` in `metrics`, or NaN when it is
+    missing.
+    """
+    if '*' not in name:
+        return _value(metrics.get(name))
+
+    regex = _regexes.get(name)
+    if regex is None:
+        regex = _regexes[name] = re.compile(pattern_to_regex(name))
+
+    xs = [_value(metrics[k]) for k in metrics if regex.fullmatch(k)]
+    return sum(xs) if xs else float('nan')
+
+def _value(metric):
+    if metric is None or 'value' not in metric or 'statistics' in metric or 'values' in metric:
+        return float('nan')
+    return metric['value']
+
+def _derived(d, y):
+    return {'type': MetricType.GAUGE,
+            'unit': d.unit,
+            'value': float(y)}
+
+def _derive_one(metrics, definitions):
+    res = dict(metrics)
+    for d in definitions:
+        try:
+            y = d.fn(*[_input(metrics, x) for x in d.inputs])
+        except ZeroDivisionError:
+            continue
+
+        if math.isfinite(y):
+            res[d.name] = _derived(d, y)
+
+    return res
+
+def derive(nodes, definitions=DERIVED):
+    """
+    Evaluates `definitions` over `nodes`, a list of (node_id, metrics)
+    tuples, with one array operation per definition across all nodes when
+    there are several, and returns the list with the derived metrics added. A derived metric is
+    left out for nodes where an input is missing or the result is not
+    finite, e.g. on a division by zero.
+    """
+    # A single node, the default, is evaluated in plain Python: importing
+    # numpy would cost a one-shot run more than the whole collection.
+    if len(nodes) <= 1:
+        return [(node_id, _derive_one(metrics, definitions)) for (node_id, metrics) in nodes]
+
+    import numpy as np
+
+    cols = dict()
+    for d in definitions:
+        for x in d.inputs:
+            if x not in cols:
+                cols[x] = np.array([_input(metrics, x) for (_, metrics) in nodes], dtype=np.float64)
+
+    res = [(node_id, dict(metrics)) for (node_id, metrics) in nodes]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for d in definitions:
+            ys = d.fn(*[cols[x] for x in d.inputs])
+
+            for i in np.flatnonzero(np.isfinite(ys)):
+                res[i][1][d.name] = _derived(d, ys[i])
+
+    return res
@@ -1,15 +1,75 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import quasardb
-import boto3
-import requests
+import copy
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
+from .dedup import ChangeFilter
+from .derived import derive
+from .instrumentation import DEFAULT_NAMESPACE as DEFAULT_SELF_NAMESPACE
+from .instrumentation import CountingConn
+from .instrumentation import Instruments
+from .instrumentation import profile
+from .instrumentation import serve_metrics
+from .keyindex import KeyIndex
+from .keyindex import node_prefix
+from .keyindex import prefix_get_all
 from .metrics import key_to_metric
 from .metrics import MetricType
+from .metrics import Tier
+from .publisher import Publisher
+from .publisher import is_retryable
+from .rates import CounterTracker
+from .rates import MODES as COUNTER_MODES
+from .rates import RATE
+from .rates import STARTUP
+from .rollup import DEFAULT_COUNTER_AGGREGATES
+from .rollup import DEFAULT_GAUGE_AGGREGATES
+from .rollup import MODES as ROLLUP_MODES
+from .rollup import NONE as NO_ROLLUP
+from .rollup import ONLY as ROLLUP_ONLY
+from .rollup import validate as validate_aggregate
+from .rollup import rollup
+from .sampling import DEFAULT_PATTERNS as DEFAULT_SAMPLE_PATTERNS
+from .sampling import MODES as SAMPLE_MODES
+from .sampling import STATS
+from .sampling import Sampler
+from .scheduler import install_signal_handlers
+from .scheduler import run_every
+from .sharding import shard
+from .sinks import CLOUDWATCH
+from .sinks import EMF
+from .sinks import SINKS
+from .sinks import EmfSink
+from .spool import Spool
+from .strings import StringCache
+from .strings import dimension_name
+from .strings import get_startup
+from .state import load_state
+from .state import save_state
+from .state import state_path
 
-def get_args():
+BOTO3 = 'boto3'
+BUILTIN = 'builtin'
+
+AWS_CLIENTS = [BOTO3, BUILTIN]
+
+# Seconds before a failed instance id lookup is attempted again.
+INSTANCE_ID_RETRY = 3600
+
+def _is_multiple(x, of):
+    n = round(x / of)
+    return n >= 1 and abs(x - n * of) <= 1e-9 * x
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser(
         description=(
             'Fetch QuasarDB metrics for local node and export to CloudWatch.'))
@@ -24,6 +84,33 @@ def get_args():
         dest='node_id',
         help='Node id to collect metrics from, e.g. 0-0-0-1')
 
+    parser.add_argument(
+        '--all-nodes',
+        dest='all_nodes',
+        action='store_true',
+        help='Discover and collect metrics from every node of the cluster, adding a NodeId dimension to each metric.')
+
+    parser.add_argument(
+        '--shard-index',
+        dest='shard_index',
+        type=int,
+        help='With --all-nodes, index of this exporter among --shard-count replicas; each replica collects the nodes consistent hashing assigns to it.',
+        default=0)
+
+    parser.add_argument(
+        '--shard-count',
+        dest='shard_count',
+        type=int,
+        help='With --all-nodes, number of exporter replicas splitting the cluster\'s nodes between them. Defaults to 1.',
+        default=1)
+
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        help='With --all-nodes, split the nodes between <workers> local worker processes, each acting as a separate shard. Defaults to 1.',
+        default=1)
+
     parser.add_argument(
         '--namespace',
         dest='namespace',
@@ -40,22 +127,352 @@ def get_args():
         dest='region_name',
         help='AWS region to export metrics in. Defaults to $AWS_DEFAULT_REGION.')
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--no-instance-id',
+        dest='lookup_instance_id',
+        action='store_false',
+        help='Do not look up the EC2 instance id when --instance-id is not given.')
+
+    parser.add_argument(
+        '--aws-client',
+        dest='aws_client',
+        choices=AWS_CLIENTS,
+        help='CloudWatch client to publish with: \'boto3\', or \'builtin\', a minimal client that starts faster and uses less memory. Defaults to \'boto3\'.',
+        default=BOTO3)
+
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        type=float,
+        help='Run as a daemon, collecting and exporting metrics every <interval> seconds. By default collects once and exits.')
+
+    parser.add_argument(
+        '--fast-interval',
+        dest='fast_interval',
+        type=float,
+        help='In daemon mode, collect metrics of the fast tier, e.g. perf.ts.table_insert.*, every <fast-interval> seconds, publishing them at 1 second resolution when below 60. --interval and --slow-interval must be multiples of it. Defaults to --interval.')
+
+    parser.add_argument(
+        '--slow-interval',
+        dest='slow_interval',
+        type=float,
+        help='In daemon mode, collect slow moving metrics of the slow tier, e.g. disk.bytes_total, every <slow-interval> seconds, a multiple of --interval or --fast-interval. Defaults to --interval.')
+
+    parser.add_argument(
+        '--concurrency',
+        dest='concurrency',
+        type=int,
+        help='Maximum number of statistics fetched concurrently over the cluster connection. Defaults to 8.',
+        default=8)
+
+    parser.add_argument(
+        '--senders',
+        dest='senders',
+        type=int,
+        help='Number of concurrent PutMetricData requests. Defaults to 4.',
+        default=4)
+
+    parser.add_argument(
+        '--key-ttl',
+        dest='key_ttl',
+        type=float,
+        help='Seconds a node\'s cached statistic key index stays valid before a full rescan. Defaults to 3600.',
+        default=3600)
+
+    parser.add_argument(
+        '--state-dir',
+        dest='state_dir',
+        help='Directory where one-shot runs keep state between invocations. Defaults to a qdb-cloudwatch directory under the system temporary directory.',
+        default=os.path.join(tempfile.gettempdir(), 'qdb-cloudwatch'))
+
+    parser.add_argument(
+        '--counters',
+        dest='counter_mode',
+        choices=COUNTER_MODES,
+        help='How cumulative counters are published: \'rate\' per second, \'delta\' per collection interval or \'raw\' cumulative values. Defaults to \'rate\'.',
+        default=RATE)
+
+    parser.add_argument(
+        '--rollup',
+        dest='rollup',
+        choices=ROLLUP_MODES,
+        help='With --all-nodes, also publish cluster-wide aggregates of every metric with Cluster and Aggregate dimensions (\'both\'), publish only those (\'only\'), or none. Defaults to \'none\'.',
+        default=NO_ROLLUP)
+
+    parser.add_argument(
+        '--rollup-counters',
+        dest='rollup_counters',
+        help='Comma separated aggregates of counters across nodes, among sum, mean, min, max and percentiles such as p90. Defaults to \'{}\''.format(','.join(DEFAULT_COUNTER_AGGREGATES)),
+        default=','.join(DEFAULT_COUNTER_AGGREGATES))
+
+    parser.add_argument(
+        '--rollup-gauges',
+        dest='rollup_gauges',
+        help='Comma separated aggregates of gauges across nodes. Defaults to \'{}\''.format(','.join(DEFAULT_GAUGE_AGGREGATES)),
+        default=','.join(DEFAULT_GAUGE_AGGREGATES))
+
+    parser.add_argument(
+        '--cluster-name',
+        dest='cluster_name',
+        help='Value of the Cluster dimension of cluster-wide aggregates. Defaults to the cluster uri.')
+
+    parser.add_argument(
+        '--string-dimensions',
+        dest='string_dimensions',
+        help='Comma separated string statistics added as dimensions to every node metric, e.g. engine_version. They are fetched again only when a node restarts.',
+        default='')
+
+    parser.add_argument(
+        '--string-properties',
+        dest='string_properties',
+        help='Comma separated string statistics added as properties to the objects written by the emf sink.',
+        default='')
+
+    parser.add_argument(
+        '--no-derived-metrics',
+        dest='derived_metrics',
+        action='store_false',
+        help='Do not publish metrics derived from the collected ones, such as cpu.utilization or requests.latency.average.')
+
+    parser.add_argument(
+        '--heartbeat',
+        dest='heartbeat',
+        type=float,
+        help='Skip publishing gauges that did not change since they were last published, republishing them at least every <heartbeat> seconds. By default every gauge is published every cycle.')
+
+    parser.add_argument(
+        '--tolerance',
+        dest='tolerance',
+        type=float,
+        help='With --heartbeat, relative change below which a gauge counts as unchanged, e.g. 0.01 for 1%%. Defaults to 0, only identical values are skipped.',
+        default=0.0)
+
+    parser.add_argument(
+        '--sink',
+        dest='sink',
+        choices=SINKS,
+        help='Where metrics are sent: \'cloudwatch\' through PutMetricData or \'emf\' as Embedded Metric Format log lines for the CloudWatch agent. Defaults to \'cloudwatch\'.',
+        default=CLOUDWATCH)
+
+    parser.add_argument(
+        '--emf-file',
+        dest='emf_file',
+        help='File the emf sink writes to, rotated by size, or \'-\' for stdout. Defaults to stdout.',
+        default='-')
+
+    parser.add_argument(
+        '--emf-max-bytes',
+        dest='emf_max_bytes',
+        type=int,
+        help='Size at which the emf file is rotated. Defaults to 64MiB.',
+        default=64 * 1024 * 1024)
+
+    parser.add_argument(
+        '--spool-max-bytes',
+        dest='spool_max_bytes',
+        type=int,
+        help='Maximum size of the on-disk spool, kept under --state-dir, where metrics that could not be published wait to be replayed. 0 disables spooling. Defaults to 64MiB.',
+        default=64 * 1024 * 1024)
 
+    parser.add_argument(
+        '--spool-drain-rate',
+        dest='spool_drain_rate',
+        type=float,
+        help='Maximum number of spooled batches replayed per second once CloudWatch is reachable again. Defaults to 5.',
+        default=5.0)
+
+    parser.add_argument(
+        '--ring-dir',
+        dest='ring_dir',
+        help='Directory of a memory-mapped ring buffer recording the raw value of every collected statistic, for export or replay with qdb-cloudwatch-ring. Disabled by default.')
+
+    parser.add_argument(
+        '--ring-capacity',
+        dest='ring_capacity',
+        type=int,
+        help='Number of collections the ring buffer keeps per node. Only used when the buffer is created. Defaults to 1440.',
+        default=1440)
+
+    parser.add_argument(
+        '--ring-max-nodes',
+        dest='ring_max_nodes',
+        type=int,
+        help='Number of nodes the ring buffer has room for. Only used when the buffer is created. Defaults to 8.',
+        default=8)
+
+    parser.add_argument(
+        '--ring-max-metrics',
+        dest='ring_max_metrics',
+        type=int,
+        help='Number of statistics the ring buffer has room for per node. Only used when the buffer is created. Defaults to 256.',
+        default=256)
+
+    parser.add_argument(
+        '--sample-interval',
+        dest='sample_interval',
+        type=float,
+        help='In daemon mode, sample the metrics selected by --sample-metrics every <sample-interval> seconds and publish their aggregate once per --interval.')
+
+    parser.add_argument(
+        '--sample-metrics',
+        dest='sample_metrics',
+        help='Comma separated list of metric name patterns sampled at --sample-interval. Defaults to \'{}\''.format(','.join(DEFAULT_SAMPLE_PATTERNS)),
+        default=','.join(DEFAULT_SAMPLE_PATTERNS))
+
+    parser.add_argument(
+        '--sample-aggregation',
+        dest='sample_aggregation',
+        choices=SAMPLE_MODES,
+        help='How samples are published: \'stats\' as min/max/sum/count statistic sets, \'values\' as distinct values and their counts. Defaults to \'stats\'.',
+        default=STATS)
+
+    parser.add_argument(
+        '--self-namespace',
+        dest='self_namespace',
+        help='Cloudwatch namespace for the exporter\'s own timings and counters. Defaults to \'{}\''.format(DEFAULT_SELF_NAMESPACE),
+        default=DEFAULT_SELF_NAMESPACE)
+
+    parser.add_argument(
+        '--no-self-metrics',
+        dest='self_metrics',
+        action='store_false',
+        help='Do not publish the exporter\'s own timings and counters to CloudWatch.')
+
+    parser.add_argument(
+        '--metrics-port',
+        dest='metrics_port',
+        type=int,
+        help='Serve the exporter\'s own timings and counters in Prometheus text format on http://<metrics-host>:<port>/metrics.')
+
+    parser.add_argument(
+        '--metrics-host',
+        dest='metrics_host',
+        help='Address the --metrics-port endpoint listens on. Defaults to 127.0.0.1, use 0.0.0.0 to expose it on every interface.',
+        default='127.0.0.1')
+
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        help='Profile the first collection cycle, writing cProfile stats to <profile> and a tracemalloc snapshot to <profile>.tracemalloc.')
+
+    args = parser.parse_args(argv)
+    if args.node_id is None and not args.all_nodes:
+        parser.error('one of --node-id or --all-nodes is required')
+
+    for (name, x) in (('--interval', args.interval),
+                      ('--fast-interval', args.fast_interval),
+                      ('--slow-interval', args.slow_interval),
+                      ('--sample-interval', args.sample_interval)):
+        if x is not None and x <= 0:
+            parser.error(name + ' must be positive')
+
+    if args.senders < 1:
+        parser.error('--senders must be at least 1')
+
+    if args.spool_drain_rate <= 0:
+        parser.error('--spool-drain-rate must be positive')
+
+    if args.sample_interval is not None and args.interval is None:
+        parser.error('--sample-interval requires --interval')
+
+    if args.sample_interval is not None and args.sink == EMF:
+        parser.error('--sample-interval cannot be combined with --sink emf, which has no statistic sets')
+
+    if (args.fast_interval is not None or args.slow_interval is not None) and args.interval is None:
+        parser.error('--fast-interval and --slow-interval require --interval')
+
+    if args.fast_interval is not None and args.fast_interval > args.interval:
+        parser.error('--fast-interval must not be above --interval')
+
+    if args.slow_interval is not None and args.slow_interval < args.interval:
+        parser.error('--slow-interval must not be below --interval')
+
+    # Tiers are collected every so many fast ticks, so their intervals must
+    # fall on that grid.
+    tick = args.fast_interval or args.interval
+    if args.interval is not None and not _is_multiple(args.interval, tick):
+        parser.error('--interval must be a multiple of --fast-interval')
+
+    if args.slow_interval is not None and not _is_multiple(args.slow_interval, tick):
+        parser.error('--slow-interval must be a multiple of --fast-interval, or of --interval without it')
+
+    if args.rollup != NO_ROLLUP and not args.all_nodes:
+        parser.error('--rollup requires --all-nodes')
+
+    if (args.shard_count > 1 or args.workers > 1) and not args.all_nodes:
+        parser.error('--shard-count and --workers require --all-nodes')
+
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        parser.error('--shard-index must be between 0 and --shard-count - 1')
+
+    if args.rollup != NO_ROLLUP and (args.shard_count > 1 or args.workers > 1):
+        parser.error('--rollup needs all nodes in a single exporter and cannot be combined with sharding')
+
+    args.rollup_counters = args.rollup_counters.split(',')
+    args.rollup_gauges = args.rollup_gauges.split(',')
+    for x in args.rollup_counters + args.rollup_gauges:
+        try:
+            validate_aggregate(x)
+        except ValueError as e:
+            parser.error(str(e))
+
+    args.string_dimensions = [x for x in args.string_dimensions.split(',') if x]
+    args.string_properties = [x for x in args.string_properties.split(',') if x]
+    if args.string_properties and args.sink != EMF:
+        parser.error('--string-properties requires --sink emf')
+
+    if args.cluster_name is None:
+        args.cluster_name = args.cluster_uri
+
+    return args
+
+# quasardb and boto3 are imported on first use: importing them costs more
+# than a whole collection cycle for one-shot runs.
 def get_qdb_conn(uri):
+    import quasardb
     return quasardb.Cluster(uri)
 
 def get_boto_client(region_name=None):
+    import boto3
     if region_name is not None:
         return boto3.client('cloudwatch', region_name=region_name)
     else:
         return boto3.client('cloudwatch')
 
+def get_cloudwatch_client(region_name=None, aws_client=BOTO3):
+    if aws_client == BUILTIN:
+        from .awsclient import get_client
+        return get_client(region_name)
+    return get_boto_client(region_name)
+
+def get_instance_id(path=None):
+    # The instance id of a host never changes, so once found it is kept in
+    # the state file; failed lookups, e.g. outside EC2, are retried hourly.
+    state = load_state(path)
+    if state is not None and (state['instance_id'] is not None or
+                              time.time() - state['fetched_at'] < INSTANCE_ID_RETRY):
+        return state['instance_id']
+
+    from .awsclient import Imds
+
+    instance_id = None
+    try:
+        instance_id = Imds().get('meta-data/instance-id')
+    except Exception as e:
+        print("unable to look up instance id from instance metadata: ", e, file=sys.stderr)
+
+    save_state(path, {'instance_id': instance_id,
+                      'fetched_at': time.time()})
+
+    return instance_id
+
 def parse_key(key):
     return key.split('.', 3)[-1]
 
-def collect_keys(conn, node_id):
-    return conn.prefix_get(str('$qdb.statistics.' + node_id), 200)
+def collect_keys(conn, node_id, key_index=None):
+    if key_index is not None:
+        return key_index.keys(conn, node_id)
+    return prefix_get_all(conn, node_prefix(node_id))
 
 def collect_metric(conn, metric_type, key):
 
@@ -65,60 +482,638 @@ def collect_metric(conn, metric_type, key):
     fn = metric_type.lookup_fn(conn)
     return fn(key).get()
 
-def collect_metrics(conn, keys):
+def collect_values(conn, lookups, concurrency=None):
+    """
+    Fetches the values of `lookups`, a list of (metric_type, key) tuples,
+    and returns them in the same order. With a concurrency above 1 the
+    lookups are spread over a bounded thread pool sharing the connection, so
+    a node's statistics take a handful of round trip latencies instead of
+    one per key.
+    """
+    def _fetch(lookup):
+        return collect_metric(conn, lookup[0], lookup[1])
+
+    if concurrency is None or concurrency <= 1 or len(lookups) <= 1:
+        return [_fetch(x) for x in lookups]
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(lookups))) as pool:
+        return list(pool.map(_fetch, lookups))
+
+def collect_strings(conn, keys, names, concurrency=None):
+    todo = []
+    for key in keys:
+        parsed = parse_key(key)
+        if parsed not in names:
+            continue
+
+        metric = key_to_metric(parsed)
+        if metric is not None and metric.type.value is MetricType.STRING.value:
+            todo.append((parsed, key, metric))
+
+    vals = collect_values(conn,
+                          [(metric.type, key) for (_, key, metric) in todo],
+                          concurrency)
+
+    return dict((parsed, val) for ((parsed, _, _), val) in zip(todo, vals))
+
+def collect_metrics(conn, keys, concurrency=None):
     res = dict()
 
+    todo = []
     for key in keys:
         # $qdb.statistics.<node_id>.foo.bar -> foo.bar
         parsed = parse_key(key)
         metric = key_to_metric(parsed)
 
-        if metric is not None and metric['type'].value is not MetricType.STRING.value:
-            val = collect_metric(conn, metric['type'], key)
-            if 'parser' in metric:
-                val = metric['parser'](val)
+        if metric is not None and metric.type.value is not MetricType.STRING.value:
+            todo.append((parsed, key, metric))
 
-            metric['value'] = val
+    vals = collect_values(conn,
+                          [(metric.type, key) for (_, key, metric) in todo],
+                          concurrency)
 
-            res[parsed] = metric
+    for ((parsed, _, metric), val) in zip(todo, vals):
+        res[parsed] = metric.sample(val)
 
     return res
 
-def _chunks(xs, n):
-    for i in range(0, len(xs), n):
-        yield xs[i:i + n]
-
-def put_metrics(client, namespace, metrics, instance_id=None):
-
+def get_dimensions(instance_id=None, node_id=None, strings=None):
     dimensions = []
     if instance_id is not None:
         dimensions.append({'Name': 'InstanceId',
                            'Value': instance_id})
 
+    if node_id is not None:
+        dimensions.append({'Name': 'NodeId',
+                           'Value': node_id})
+
+    if strings is not None:
+        for k in sorted(strings):
+            # CloudWatch rejects empty values and duplicate names, e.g.
+            # node_id next to the NodeId dimension.
+            if strings[k] and dimension_name(k) not in [x['Name'] for x in dimensions]:
+                dimensions.append({'Name': dimension_name(k),
+                                   'Value': strings[k]})
+
+    return dimensions
+
+def get_rollup_dimensions(cluster_name, aggregate, instance_id=None):
+    dimensions = get_dimensions(instance_id)
+    dimensions.append({'Name': 'Cluster',
+                       'Value': cluster_name})
+    dimensions.append({'Name': 'Aggregate',
+                       'Value': aggregate})
+
+    return dimensions
+
+def to_datums(metrics, dimensions, timestamp=None, properties=None, high_resolution=False):
     xs = []
     for k in metrics:
         v = metrics[k]
 
-        xs.append({'Dimensions': dimensions,
-                   'MetricName': k,
-                   'Value': v['value'],
-                   'Unit': v['unit']})
+        x = {'Dimensions': dimensions,
+             'MetricName': k,
+             'Unit': v['unit']}
+
+        if timestamp is not None:
+            x['Timestamp'] = timestamp
+
+        if high_resolution and v.get('tier') is Tier.FAST:
+            x['StorageResolution'] = 1
+
+        # Only understood by the emf sink, never sent to PutMetricData.
+        if properties:
+            x['Properties'] = properties
+
+        if 'statistics' in v:
+            x['StatisticValues'] = v['statistics']
+        elif 'values' in v:
+            x['Values'] = v['values']
+            x['Counts'] = v['counts']
+        else:
+            x['Value'] = v['value']
+
+        xs.append(x)
+
+    return xs
+
+def put_datums(client, namespace, xs, sink=None):
+    # A sink is anything with publish(datums, namespace), e.g. a Publisher
+    # sending to CloudWatch or an EmfSink; without one we publish through a
+    # short-lived Publisher on `client`.
+    if sink is not None:
+        return sink.publish(xs, namespace)
+
+    sink = Publisher(client, namespace)
+    try:
+        return sink.publish(xs)
+    finally:
+        sink.close()
+
+def put_metrics(client, namespace, metrics, instance_id=None, node_id=None, sink=None, timestamp=None):
+    return put_datums(client, namespace,
+                      to_datums(metrics, get_dimensions(instance_id, node_id), timestamp),
+                      sink)
+
+# Upper bound on the number of nodes collected in parallel in cluster mode.
+MAX_NODE_WORKERS = 32
+
+# One-shot runs replay at most this many spooled batches before exiting, so
+# a large backlog is drained over several runs.
+ONE_SHOT_DRAIN_BATCHES = 50
+
+class Session(object):
+    """
+    Keeps the cluster connection and CloudWatch client alive across collection
+    cycles. Both are created lazily and dropped whenever a cycle fails, so the
+    next cycle transparently reconnects.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self._conn = None
+        self._node_conns = dict()
+        self._client = None
+        self._sink = None
+        # The sampler thread shares the connections, the drainer thread the
+        # sink.
+        self._conn_lock = threading.Lock()
+        self._sink_lock = threading.Lock()
+        self.instruments = Instruments()
+        self.node_strings = dict()
+
+        # Daemons tick at the fastest tier's interval; each tier is collected
+        # every so many ticks. One-shot runs collect every tier.
+        self.started = None
+        self.tick = -1
+        self.tick_interval = args.interval
+        self.tier_ticks = dict((tier, 1) for tier in Tier)
+        self.high_resolution = False
+        if args.interval is not None:
+            self.tick_interval = args.fast_interval or args.interval
+            self.tier_ticks = {Tier.FAST: 1,
+                               Tier.NORMAL: max(1, int(round(args.interval / self.tick_interval))),
+                               Tier.SLOW: max(1, int(round((args.slow_interval or args.interval) / self.tick_interval)))}
+            self.high_resolution = args.fast_interval is not None and args.fast_interval < 60
+
+        self.key_index = KeyIndex(args.key_ttl, self._state('keys.json'))
+        self.counters = CounterTracker(args.counter_mode, self._state('counters.json'))
+
+        self.strings = None
+        if args.string_dimensions or args.string_properties:
+            self.strings = StringCache(self._state('strings.json'))
+
+        self.changes = None
+        if args.heartbeat is not None:
+            self.changes = ChangeFilter(args.heartbeat, args.tolerance, self._state('published.json'))
+
+        self.sampler = None
+        if args.sample_interval is not None:
+            self.sampler = Sampler(args.sample_metrics.split(','), args.sample_aggregation)
+
+        self.spool = None
+        if args.spool_max_bytes > 0:
+            self.spool = Spool(os.path.join(args.state_dir, 'spool'), args.spool_max_bytes)
+
+        self.ring = None
+        if args.ring_dir is not None:
+            # Imported here: it needs numpy, which plain runs do not load.
+            from .ringbuffer import RingBuffer
+            self.ring = RingBuffer(args.ring_dir, args.ring_capacity,
+                                   args.ring_max_nodes, args.ring_max_metrics)
+
+    def _state(self, name):
+        # Daemons keep their state in memory, one-shot runs persist it
+        # under --state-dir for the next run.
+        if self.args.interval is not None:
+            return None
+        return state_path(self.args.state_dir, name)
+
+    def _connect(self, node_id=None):
+        # Connecting can be slow, so it happens outside the lock; a thread
+        # that loses the race closes its connection and uses the winner's.
+        conn = CountingConn(get_qdb_conn(self.args.cluster_uri), self.instruments)
+
+        with self._conn_lock:
+            winner = self._conn if node_id is None else self._node_conns.get(node_id)
+            if winner is None:
+                if node_id is None:
+                    self._conn = conn
+                else:
+                    self._node_conns[node_id] = conn
+                return conn
+
+        self._close_conn(conn)
+        return winner
+
+    def conn(self):
+        with self._conn_lock:
+            if self._conn is not None:
+                return self._conn
+
+        return self._connect()
+
+    def node_conn(self, node_id):
+        # In cluster mode each node is fetched over its own connection so
+        # slow nodes do not queue behind each other.
+        if not self.args.all_nodes:
+            return self.conn()
+
+        with self._conn_lock:
+            if node_id in self._node_conns:
+                return self._node_conns[node_id]
+
+        return self._connect(node_id)
+
+    def client(self):
+        if self._client is None:
+            self._client = get_cloudwatch_client(self.args.region_name, self.args.aws_client)
+        return self._client
+
+    def sink(self):
+        with self._sink_lock:
+            if self._sink is None:
+                if self.args.sink == EMF:
+                    self._sink = EmfSink(self.args.namespace, self.args.emf_file, self.args.emf_max_bytes)
+                else:
+                    self._sink = Publisher(self.client(), self.args.namespace, self.args.senders,
+                                           instruments=self.instruments)
+            return self._sink
+
+    def _close_conn(self, conn):
+        if conn is not None and hasattr(conn, 'close'):
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def close_node(self, node_id):
+        with self._conn_lock:
+            conn = self._node_conns.pop(node_id, None)
+        self._close_conn(conn)
+
+    def close_conns(self):
+        with self._conn_lock:
+            conns = [self._conn] + list(self._node_conns.values())
+            self._conn = None
+            self._node_conns = dict()
+
+        for conn in conns:
+            self._close_conn(conn)
+
+    def close_sink(self):
+        with self._sink_lock:
+            sink = self._sink
+            self._client = None
+            self._sink = None
+
+        if sink is not None:
+            sink.close()
+
+    def close(self):
+        self.close_conns()
+        self.close_sink()
+
+    def node_ids(self):
+        if self.args.all_nodes:
+            return shard(self.key_index.nodes(self.conn()),
+                         self.args.shard_index,
+                         self.args.shard_count)
+        return [self.args.node_id]
+
+    def due_tiers(self, now=None):
+        # Ticks are numbered from the elapsed time rather than counted, so
+        # the ticks run_every skips after a slow cycle do not push the
+        # slower tiers back. A tier is due once its grid point has passed.
+        tick = self.tick + 1
+        if self.tick_interval is not None:
+            if now is None:
+                now = time.monotonic()
+            if self.started is None:
+                self.started = now
+            tick = max(tick, int(round((now - self.started) / self.tick_interval)))
+
+        due = set(tier for (tier, n) in self.tier_ticks.items() if tick // n > self.tick // n)
+        self.tick = tick
+        return due
+
+    def collect_node(self, node_id, tiers=None):
+        conn = self.node_conn(node_id)
+        with self.instruments.timed('collect_keys'):
+            keys = collect_keys(conn, node_id, self.key_index)
+
+        # startup is always fetched, counter resets are detected with it.
+        due = keys
+        if tiers is not None and len(tiers) < len(Tier):
+            due = [k for k in keys if parse_key(k) == STARTUP or self._in_tiers(parse_key(k), tiers)]
+
+        # The sampler already fetched its metrics this window; the cycle
+        # takes their latest sample instead.
+        if self.sampler is not None and tiers is not None and Tier.NORMAL in tiers:
+            owned = self.sampler.owned(node_id)
+            due = [k for k in due if parse_key(k) == STARTUP or parse_key(k) not in owned]
 
-    # create chunks of at most 20 metrics
-    results = list()
-    for chunk in _chunks(xs, 20):
-        results.append(client.put_metric_data(Namespace=namespace,
-                                              MetricData=chunk))
+        self.instruments.incr('keys', len(due))
 
-    return results
+        with self.instruments.timed('collect_metrics'):
+            metrics = collect_metrics(conn, due, self.args.concurrency)
+
+        if self.strings is not None:
+            names = set(self.args.string_dimensions + self.args.string_properties)
+            strings = self.strings.get(node_id, names, get_startup(metrics),
+                                       lambda xs: collect_strings(conn, keys, xs, self.args.concurrency))
+            self.node_strings[node_id] = strings
+
+        return metrics
+
+    def _in_tiers(self, name, tiers):
+        metric = key_to_metric(name)
+        return metric is not None and metric.tier in tiers
+
+    def collect(self, tiers=None):
+        """
+        Collects the metrics of `tiers` on all nodes, returning a list of
+        (node_id, metrics) tuples. In cluster mode nodes are fetched in
+        parallel and a failing node is reported and skipped rather than
+        failing the cycle.
+        """
+        node_ids = self.node_ids()
+        if not self.args.all_nodes:
+            return [(node_id, self.collect_node(node_id, tiers)) for node_id in node_ids]
+
+        def _collect(node_id):
+            try:
+                return (node_id, self.collect_node(node_id, tiers))
+            except Exception as e:
+                print("unable to collect node ", node_id, ": ", e, file=sys.stderr)
+                self.close_node(node_id)
+                self.key_index.invalidate(node_id)
+                return (node_id, None)
+
+        with ThreadPoolExecutor(max_workers=min(MAX_NODE_WORKERS, len(node_ids) or 1)) as pool:
+            return [x for x in pool.map(_collect, node_ids) if x[1] is not None]
+
+    def sample(self):
+        for node_id in self.node_ids():
+            conn = self.node_conn(node_id)
+            # Slow tier metrics rarely change; sampling them is wasted work.
+            keys = [k for k in collect_keys(conn, node_id, self.key_index)
+                    if self.sampler.matches(parse_key(k)) and not self._in_tiers(parse_key(k), (Tier.SLOW,))]
+
+            metrics = collect_metrics(conn, keys, self.args.concurrency)
+            self.sampler.add(node_id, metrics, time.monotonic())
+
+    def publish(self, xs):
+        self.instruments.incr('datums', len(xs))
+
+        try:
+            with self.instruments.timed('put_metrics'):
+                result = put_datums(None, self.args.namespace, xs, self.sink())
+        except Exception:
+            self.close_sink()
+            if self.spool is not None:
+                self.spool.append(self.args.namespace, xs)
+            raise
+
+        if self.spool is not None:
+            # Batches rejected for good, e.g. failing validation, would
+            # only be rejected again on replay.
+            for (batch, e) in result.failed:
+                if is_retryable(e):
+                    self.spool.append(self.args.namespace, batch)
+
+        return result
+
+    def _replay(self, namespace, datums):
+        return self.sink().publish(datums, namespace).ok
+
+    def drain(self, stop=None, limit=None):
+        if self.spool is None or self.spool.empty():
+            return 0
+
+        n = self.spool.drain(self._replay, self.args.spool_drain_rate, stop, limit)
+        self.report("replayed ", n, " spooled batches")
+        return n
+
+    def report(self, *xs):
+        # Keep stdout clean for the CloudWatch agent when it carries EMF lines.
+        out = sys.stdout
+        if self.args.sink == EMF and self.args.emf_file == '-':
+            out = sys.stderr
+
+        print(*xs, file=out)
+
+    def publish_self(self, now):
+        current = self.instruments.reset()
+        if not self.args.self_metrics:
+            return
+
+        # Workers and replicas sharing a host would otherwise merge into
+        # one series.
+        dimensions = get_dimensions(self.args.instance_id)
+        if self.args.shard_count > 1:
+            dimensions.append({'Name': 'Shard',
+                               'Value': '{}/{}'.format(self.args.shard_index, self.args.shard_count)})
+
+        xs = to_datums(self.instruments.to_metrics(current), dimensions, now)
+        self.sink().publish(xs, self.args.self_namespace)
+
+    def cycle(self):
+        try:
+            now = time.time()
+            tiers = self.due_tiers()
+            self.instruments.incr('cycles')
+
+            with self.instruments.timed('cycle'):
+                merge = self.sampler is not None and Tier.NORMAL in tiers
+
+                nodes = []
+                for (node_id, metrics) in self.collect(tiers):
+                    if merge:
+                        latest = self.sampler.latest(node_id)
+                        latest.update(metrics)
+                        metrics = latest
+                    if self.ring is not None:
+                        self.ring.write(node_id, metrics, now)
+                    nodes.append((node_id, self.counters.convert(node_id, metrics)))
+
+                # Derived metrics and rollups work on the scalar values, so
+                # they are computed before sampled windows replace them.
+                if self.args.derived_metrics:
+                    nodes = derive(nodes)
+
+                xs = []
+                if self.args.rollup != NO_ROLLUP:
+                    for (aggregate, metrics) in rollup(nodes, self.args.rollup_counters, self.args.rollup_gauges):
+                        dimensions = get_rollup_dimensions(self.args.cluster_name, aggregate, self.args.instance_id)
+                        xs.extend(to_datums(metrics, dimensions, now, None, self.high_resolution))
+
+                if merge:
+                    nodes = [(node_id, self.sampler.merge(node_id, metrics)) for (node_id, metrics) in nodes]
+
+                if self.args.rollup == ROLLUP_ONLY:
+                    nodes = []
+
+                for (node_id, metrics) in nodes:
+                    if self.changes is not None:
+                        metrics = self.changes.filter(node_id, metrics, now)
+
+                    tag = node_id if self.args.all_nodes else None
+                    strings = self.node_strings.get(node_id, dict())
+                    dimensions = get_dimensions(self.args.instance_id, tag,
+                                                dict((k, strings.get(k)) for k in self.args.string_dimensions))
+                    properties = dict((k, strings[k]) for k in self.args.string_properties if k in strings)
+
+                    xs.extend(to_datums(metrics, dimensions, now, properties, self.high_resolution))
+
+                # State is written once per cycle rather than once per node.
+                self.counters.save()
+                if self.changes is not None:
+                    self.changes.save()
+                if self.strings is not None:
+                    self.strings.save()
+
+                result = self.publish(xs)
+
+            # Fast tier ticks would publish our own metrics far too often.
+            if Tier.NORMAL in tiers:
+                self.publish_self(now)
+            return result
+        except Exception:
+            self.instruments.incr('cycle_errors')
+            # Publishing failures already reset the sink; keep it otherwise,
+            # the drainer may be using it.
+            self.close_conns()
+            self.key_index.invalidate()
+            raise
+
+def _daemon_cycle(session):
+    try:
+        result = session.cycle()
+        session.report(result)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+
+def _drain_cycle(session, stop):
+    try:
+        session.drain(stop)
+    except Exception as e:
+        print("unable to replay spooled metrics: ", e, file=sys.stderr)
+
+def _sample_cycle(session):
+    try:
+        session.sample()
+    except Exception as e:
+        print("unable to sample metrics: ", e, file=sys.stderr)
+
+def _profile_first(fn, path):
+    pending = [True]
+
+    def _fn():
+        if pending:
+            pending.pop()
+            return profile(fn, path)
+        return fn()
+
+    return _fn
+
+def worker_args(args, index):
+    # Each local worker is a shard of its own, with its own state and
+    # metrics port so they do not step on each other.
+    res = copy.copy(args)
+    res.workers = 1
+    res.shard_count = args.shard_count * args.workers
+    res.shard_index = args.shard_index * args.workers + index
+    res.state_dir = os.path.join(args.state_dir, 'shard-{}'.format(res.shard_index))
+    if args.ring_dir is not None:
+        res.ring_dir = os.path.join(args.ring_dir, 'shard-{}'.format(res.shard_index))
+    if args.metrics_port is not None:
+        res.metrics_port = args.metrics_port + index
+    if args.profile is not None:
+        res.profile = '{}.{}'.format(args.profile, index)
+
+    return res
+
+def run_workers(args):
+    # Imported here: only --workers needs it, one-shot runs should not pay
+    # for it.
+    import multiprocessing
+
+    workers = [multiprocessing.Process(target=run,
+                                       args=(worker_args(args, i),),
+                                       name='qdb-cloudwatch-worker-{}'.format(i))
+               for i in range(args.workers)]
+
+    for p in workers:
+        p.start()
+
+    # Installed once the workers are started so they do not inherit it;
+    # terminating a worker sends it SIGTERM, which it handles gracefully.
+    def _handler(signum, frame):
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _handler)
+
+    for p in workers:
+        p.join()
+
+    if any(p.exitcode != 0 for p in workers):
+        sys.exit(1)
 
 def main():
     args = get_args()
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        run(args)
+
+def run(args):
+    if args.instance_id is None and args.lookup_instance_id:
+        args.instance_id = get_instance_id(state_path(args.state_dir, 'instance.json'))
+
+    session = Session(args)
+
+    if args.metrics_port is not None:
+        serve_metrics(session.instruments, args.metrics_port, args.metrics_host)
+
+    if args.interval is None:
+        try:
+            if args.profile is not None:
+                result = profile(session.cycle, args.profile)
+            else:
+                result = session.cycle()
+            session.report(result)
+            if result.ok:
+                session.drain(limit=ONE_SHOT_DRAIN_BATCHES)
+        finally:
+            session.close()
+        return
+
+    stop = threading.Event()
+    install_signal_handlers(stop)
+
+    if session.sampler is not None:
+        sampler = threading.Thread(target=run_every,
+                                   args=(args.sample_interval, lambda: _sample_cycle(session), stop),
+                                   name='qdb-cloudwatch-sampler')
+        sampler.daemon = True
+        sampler.start()
 
-    conn = get_qdb_conn(args.cluster_uri)
-    keys = collect_keys(conn, args.node_id)
-    metrics = collect_metrics(conn, keys)
+    if session.spool is not None:
+        drainer = threading.Thread(target=run_every,
+                                   args=(args.interval, lambda: _drain_cycle(session, stop), stop),
+                                   name='qdb-cloudwatch-drainer')
+        drainer.daemon = True
+        drainer.start()
 
-    result = put_metrics(get_boto_client(args.region_name), args.namespace, metrics, args.instance_id)
+    fn = lambda: _daemon_cycle(session)
+    if args.profile is not None:
+        fn = _profile_first(fn, args.profile)
 
-    print("result = ", result)
+    try:
+        run_every(session.tick_interval, fn, stop)
+    finally:
+        session.close()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+from .metrics import MetricType
+
+DEFAULT_NAMESPACE = 'QuasarDB/Exporter'
+
+PROMETHEUS_PREFIX = 'qdb_cloudwatch_'
+
+# Counters the exporter keeps about itself, with their CloudWatch unit.
+COUNTERS = {'cycles': 'Count',
+            'cycle_errors': 'Count',
+            'round_trips': 'Count',
+            'keys': 'Count',
+            'datums': 'Count',
+            'api_calls': 'Count',
+            'api_errors': 'Count'}
+
+STAGES = ['collect_keys', 'collect_metrics', 'put_metrics', 'cycle']
+
+class Instruments(object):
+    """
+    Thread safe timings and counters of the exporter's own hot paths. Values
+    are kept both for the cycle in progress, which is published next to the
+    node metrics, and as running totals exposed to Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = dict()
+        self.totals = dict()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.current[name] = self.current.get(name, 0) + n
+            self.totals[name] = self.totals.get(name, 0) + n
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.incr(stage + '_seconds', time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            current = self.current
+            self.current = dict()
+            return current
+
+    def to_metrics(self, current):
+        res = dict()
+        for name in COUNTERS:
+            res[name] = {'type': MetricType.GAUGE,
+                         'unit': COUNTERS[name],
+                         'value': current.get(name, 0)}
+
+        for stage in STAGES:
+            res[stage + '_seconds'] = {'type': MetricType.GAUGE,
+                                       'unit': 'Seconds',
+                                       'value': current.get(stage + '_seconds', 0.0)}
+
+        return res
+
+    def to_prometheus(self):
+        with self._lock:
+            totals = dict(self.totals)
+
+        lines = []
+        for name in sorted(COUNTERS):
+            metric = PROMETHEUS_PREFIX + name + '_total'
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, totals.get(name, 0)))
+
+        metric = PROMETHEUS_PREFIX + 'stage_seconds_total'
+        lines.append('# TYPE {} counter'.format(metric))
+        for stage in STAGES:
+            lines.append('{}{{stage="{}"}} {}'.format(metric, stage, totals.get(stage + '_seconds', 0.0)))
+
+        return '\n'.join(lines) + '\n'
+
+class _Entry(object):
+    def __init__(self, entry, instruments):
+        self._entry = entry
+        self._instruments = instruments
+
+    def get(self):
+        self._instruments.incr('round_trips')
+        return self._entry.get()
+
+class CountingConn(object):
+    """
+    Wraps a cluster connection to count the round trips made through it.
+    """
+
+    def __init__(self, conn, instruments):
+        self._conn = conn
+        self._instruments = instruments
+
+        # Only offered when the connection has it, so callers can still
+        # fall back on connections without it.
+        if hasattr(conn, 'prefix_count'):
+            self.prefix_count = self._prefix_count
+
+    def prefix_get(self, prefix, max_count):
+        self._instruments.incr('round_trips')
+        return self._conn.prefix_get(prefix, max_count)
+
+    def _prefix_count(self, prefix):
+        self._instruments.incr('round_trips')
+        return self._conn.prefix_count(prefix)
+
+    def integer(self, key):
+        return _Entry(self._conn.integer(key), self._instruments)
+
+    def blob(self, key):
+        return _Entry(self._conn.blob(key), self._instruments)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def serve_metrics(instruments, port, host='127.0.0.1'):
+    """
+    Serves the running totals of `instruments` in Prometheus text format on
+    http://<host>:<port>/metrics from a background thread.
+    """
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = instruments.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    t = threading.Thread(target=server.serve_forever, name='qdb-cloudwatch-metrics')
+    t.daemon = True
+    t.start()
+
+    return server
+
+def profile(fn, path):
+    """
+    Runs `fn` under cProfile and tracemalloc, writing the profile to `path`
+    and the memory snapshot to `path` + '.tracemalloc'.
+    """
+    import cProfile
+    import tracemalloc
+
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn)
+    finally:
+        profiler.dump_stats(path)
+        tracemalloc.take_snapshot().dump(path + '.tracemalloc')
+        tracemalloc.stop()
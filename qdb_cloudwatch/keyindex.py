@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from .state import load_state
+from .state import save_state
+
+STATISTICS_PREFIX = '$qdb.statistics.'
+
+def node_prefix(node_id):
+    return str(STATISTICS_PREFIX + node_id + '.')
+
+def prefix_get_all(conn, prefix, page_size=200):
+    # prefix_get only takes an upper bound on the number of results, so we
+    # grow the bound until the result is no longer truncated.
+    n = page_size
+    while True:
+        keys = conn.prefix_get(prefix, n)
+        if len(keys) < n:
+            return keys
+        n *= 2
+
+def key_node_id(key):
+    # $qdb.statistics.<node_id>.foo.bar -> <node_id>
+    return key[len(STATISTICS_PREFIX):].split('.', 1)[0]
+
+def prefix_count(conn, prefix):
+    if not hasattr(conn, 'prefix_count'):
+        return None
+    return conn.prefix_count(prefix)
+
+class KeyIndex(object):
+    """
+    Caches the statistic keys of each node. An entry is reused until its ttl
+    expires or a cheap prefix_count shows the node's statistic set changed;
+    only then is the full prefix scan repeated. With a path, the index is
+    persisted so successive one-shot runs share it.
+    """
+
+    def __init__(self, ttl, path=None, page_size=200):
+        self.ttl = ttl
+        self.path = path
+        self.page_size = page_size
+        self._lock = threading.Lock()
+
+        state = load_state(path) or dict()
+        self._nodes = state.get('nodes')
+        self._entries = state.get('keys', dict())
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched_at'] < self.ttl
+
+    def _save(self):
+        save_state(self.path, {'nodes': self._nodes,
+                               'keys': self._entries})
+
+    def nodes(self, conn):
+        """
+        Discovers the ids of all nodes exposing statistics. The scan lists
+        every statistic of the cluster, so it also refreshes the key entries
+        of each node it finds.
+        """
+        with self._lock:
+            if self._fresh(self._nodes):
+                count = prefix_count(conn, STATISTICS_PREFIX)
+                if count is None or count == self._nodes['count']:
+                    return self._nodes['ids']
+
+            keys = prefix_get_all(conn, STATISTICS_PREFIX, self.page_size)
+            now = time.time()
+
+            by_node = dict()
+            for key in keys:
+                by_node.setdefault(key_node_id(key), []).append(key)
+
+            for (node_id, xs) in by_node.items():
+                self._entries[node_id] = {'keys': xs,
+                                          'count': len(xs),
+                                          'fetched_at': now}
+
+            self._nodes = {'ids': sorted(by_node),
+                           'count': len(keys),
+                           'fetched_at': now}
+            self._save()
+
+            return self._nodes['ids']
+
+    def keys(self, conn, node_id):
+        prefix = node_prefix(node_id)
+
+        with self._lock:
+            entry = self._entries.get(node_id)
+
+        if self._fresh(entry):
+            count = prefix_count(conn, prefix)
+            if count is None or count == entry['count']:
+                return entry['keys']
+
+        keys = prefix_get_all(conn, prefix, self.page_size)
+
+        with self._lock:
+            self._entries[node_id] = {'keys': keys,
+                                      'count': len(keys),
+                                      'fetched_at': time.time()}
+            self._save()
+
+        return keys
+
+    def invalidate(self, node_id=None):
+        with self._lock:
+            if node_id is None:
+                self._nodes = None
+                self._entries.clear()
+            else:
+                self._entries.pop(node_id, None)
+
+            self._save()
@@ -1,7 +1,10 @@
-
 from functools import partial
 from enum import Enum
 
+import re
+import sys
+import threading
+
 def nanos_to_micros(x):
     return x / 1000
 
@@ -18,337 +21,155 @@ class MetricType(Enum):
         else:
             raise RuntimeError("Invalid value: ", str(self))
 
-METRICS = {'cpu.idle': {'type': MetricType.COUNTER,
-                        'unit': 'Microseconds',
-                        'parser': nanos_to_micros},
-           'cpu.system': {'type': MetricType.COUNTER,
-                          'unit': 'Microseconds',
-                          'parser': nanos_to_micros},
-           'cpu.user': {'type': MetricType.COUNTER,
-                        'unit': 'Microseconds',
-                        'parser': nanos_to_micros},
-           'disk.bytes_free': {'type': MetricType.GAUGE,
-                               'unit': 'Bytes'},
-           'disk.bytes_total': {'type': MetricType.GAUGE,
-                                'unit': 'Bytes'},
-           'disk.path': {'type': MetricType.STRING,
-                         'unit': None},
-           'engine_build_date': {'type': MetricType.STRING,
-                                 'unit': None},
-           'engine_version': {'type': MetricType.STRING,
-                              'unit': None},
-           'hardware_concurrency': {'type': MetricType.GAUGE,
-                                    'unit': 'Count'},
-           'memory.bytes_resident_size': {'type': MetricType.GAUGE,
-                                          'unit': 'Bytes'},
-           'memory.physmem.bytes_total': {'type': MetricType.GAUGE,
-                                          'unit': 'Bytes'},
-           'memory.physmem.bytes_used': {'type': MetricType.GAUGE,
-                                         'unit': 'Bytes'},
-           'memory.resident_count': {'type': MetricType.GAUGE,
-                                     'unit': 'Count'},
-           'memory.vm.bytes_total': {'type': MetricType.GAUGE,
-                                     'unit': 'Bytes'},
-           'memory.vm.bytes_used': {'type': MetricType.GAUGE,
-                                    'unit': 'Bytes'},
-           'network.current_users_count': {'type': MetricType.GAUGE,
-                                           'unit': 'Count'},
-           'network.sessions.available_count': {'type': MetricType.GAUGE,
-                                                'unit': 'Count'},
-           'network.sessions.max_count': {'type': MetricType.GAUGE,
-                                          'unit': 'Count'},
-           'network.sessions.unavailable_count': {'type': MetricType.GAUGE,
-                                                  'unit': 'Count'},
-           'node_id': {'type': MetricType.STRING,
-                       'unit': None},
-           'operating_system': {'type': MetricType.STRING,
-                                'unit': None},
-           'partitions_count': {'type': MetricType.GAUGE,
-                                'unit': 'Count'},
-           'perf.blob.update.content_writing.total_ns': {'type': MetricType.COUNTER,
-                                                         'unit': 'Microseconds',
-                                                         'parser': nanos_to_micros},
-           'perf.blob.update.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                         'unit': 'Microseconds',
-                                                         'parser': nanos_to_micros},
-           'perf.blob.update.entry_trimming.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'perf.blob.update.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.blob.update.processing.total_ns': {'type': MetricType.COUNTER,
-                                                    'unit': 'Microseconds',
-                                                    'parser': nanos_to_micros},
-           'perf.common.get.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'perf.common.get.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'perf.common.get.processing.total_ns': {'type': MetricType.COUNTER,
-                                                   'unit': 'Microseconds',
-                                                   'parser': nanos_to_micros},
-           'perf.common.get_by_affix.affix_search.total_ns': {'type': MetricType.COUNTER,
-                                                              'unit': 'Microseconds',
-                                                              'parser': nanos_to_micros},
-           'perf.common.get_by_affix.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                 'unit': 'Microseconds',
-                                                                 'parser': nanos_to_micros},
-           'perf.common.get_by_affix.processing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.common.get_metadata.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                 'unit': 'Microseconds',
-                                                                 'parser': nanos_to_micros},
-           'perf.common.get_metadata.processing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.common.get_range.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                              'unit': 'Microseconds',
-                                                              'parser': nanos_to_micros},
-           'perf.common.get_range.processing.total_ns': {'type': MetricType.COUNTER,
-                                                         'unit': 'Microseconds',
-                                                         'parser': nanos_to_micros},
-           'perf.common.get_versions.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                 'unit': 'Microseconds',
-                                                                 'parser': nanos_to_micros},
-           'perf.common.get_versions.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                 'unit': 'Microseconds',
-                                                                 'parser': nanos_to_micros},
-           'perf.common.get_versions.processing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.common.set_transaction_state.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                          'unit': 'Microseconds',
-                                                                          'parser': nanos_to_micros},
-           'perf.common.set_transaction_state.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                          'unit': 'Microseconds',
-                                                                          'parser': nanos_to_micros},
-           'perf.common.set_transaction_state.entry_trimming.total_ns': {'type': MetricType.COUNTER,
-                                                                         'unit': 'Microseconds',
-                                                                         'parser': nanos_to_micros},
-           'perf.common.set_transaction_state.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                                        'unit': 'Microseconds',
-                                                                        'parser': nanos_to_micros},
-           'perf.common.set_transaction_state.processing.total_ns': {'type': MetricType.COUNTER,
-                                                                     'unit': 'Microseconds',
-                                                                     'parser': nanos_to_micros},
-           'perf.control.system.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.control.system.processing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.control.status.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.control.status.processing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.integer.update.content_writing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.integer.update.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.integer.update.entry_trimming.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.integer.update.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                          'unit': 'Microseconds',
-                                                          'parser': nanos_to_micros},
-           'perf.integer.update.processing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.placeholder.put.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.placeholder.put.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.placeholder.put.processing.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'perf.tag.leaf_insert.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.tag.leaf_insert.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.tag.leaf_insert.processing.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'perf.ts.aggregate_table.affix_search.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.ts.aggregate_table.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                'unit': 'Microseconds',
-                                                                'parser': nanos_to_micros},
-           'perf.ts.aggregate_table.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                'unit': 'Microseconds',
-                                                                'parser': nanos_to_micros},
-           'perf.ts.aggregate_table.directory_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                  'unit': 'Microseconds',
-                                                                  'parser': nanos_to_micros},
-           'perf.ts.aggregate_table.processing.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.ts.aggregate_table.serialization.total_ns': {'type': MetricType.COUNTER,
-                                                              'unit': 'Microseconds',
-                                                              'parser': nanos_to_micros},
-           'perf.ts.blob_insert.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.blob_insert.content_writing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.blob_insert.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.blob_insert.directory_writing.total_ns': {'type': MetricType.COUNTER,
-                                                              'unit': 'Microseconds',
-                                                              'parser': nanos_to_micros},
-           'perf.ts.blob_insert.entry_trimming.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.ts.blob_insert.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                          'unit': 'Microseconds',
-                                                          'parser': nanos_to_micros},
-           'perf.ts.blob_insert.processing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.ts.blob_insert.ts_bucket_updating.total_ns': {'type': MetricType.COUNTER,
-                                                               'unit': 'Microseconds',
-                                                               'parser': nanos_to_micros},
-           'perf.ts.create_root.content_writing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.create_root.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.create_root.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                          'unit': 'Microseconds',
-                                                          'parser': nanos_to_micros},
-           'perf.ts.create_root.processing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.ts.double_aggregate.affix_search.total_ns': {'type': MetricType.COUNTER,
-                                                              'unit': 'Microseconds',
-                                                              'parser': nanos_to_micros},
-           'perf.ts.double_aggregate.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                 'unit': 'Microseconds',
-                                                                 'parser': nanos_to_micros},
-           'perf.ts.double_aggregate.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                 'unit': 'Microseconds',
-                                                                 'parser': nanos_to_micros},
-           'perf.ts.double_aggregate.directory_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                   'unit': 'Microseconds',
-                                                                   'parser': nanos_to_micros},
-           'perf.ts.double_aggregate.processing.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.double_aggregate.serialization.total_ns': {'type': MetricType.COUNTER,
-                                                               'unit': 'Microseconds',
-                                                               'parser': nanos_to_micros},
-           'perf.ts.get_column_info.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                'unit': 'Microseconds',
-                                                                'parser': nanos_to_micros},
-           'perf.ts.get_column_info.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                'unit': 'Microseconds',
-                                                                'parser': nanos_to_micros},
-           'perf.ts.get_column_info.processing.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.ts.get_columns.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.get_columns.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.get_columns.processing.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.ts.get_range.affix_search.total_ns': {'type': MetricType.COUNTER,
-                                                       'unit': 'Microseconds',
-                                                       'parser': nanos_to_micros},
-           'perf.ts.get_range.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                          'unit': 'Microseconds',
-                                                          'parser': nanos_to_micros},
-           'perf.ts.get_range.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                          'unit': 'Microseconds',
-                                                          'parser': nanos_to_micros},
-           'perf.ts.get_range.directory_reading.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.get_range.processing.total_ns': {'type': MetricType.COUNTER,
-                                                     'unit': 'Microseconds',
-                                                     'parser': nanos_to_micros},
-           'perf.ts.get_range.serialization.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'perf.ts.int64_aggregate.affix_search.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.ts.int64_aggregate.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                'unit': 'Microseconds',
-                                                                'parser': nanos_to_micros},
-           'perf.ts.int64_aggregate.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                                'unit': 'Microseconds',
-                                                                'parser': nanos_to_micros},
-           'perf.ts.int64_aggregate.directory_reading.total_ns': {'type': MetricType.COUNTER,
-                                                                  'unit': 'Microseconds',
-                                                                  'parser': nanos_to_micros},
-           'perf.ts.int64_aggregate.processing.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.ts.int64_aggregate.serialization.total_ns': {'type': MetricType.COUNTER,
-                                                              'unit': 'Microseconds',
-                                                              'parser': nanos_to_micros},
-           'perf.ts.table_insert.content_reading.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.ts.table_insert.content_writing.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.ts.table_insert.deserialization.total_ns': {'type': MetricType.COUNTER,
-                                                             'unit': 'Microseconds',
-                                                             'parser': nanos_to_micros},
-           'perf.ts.table_insert.directory_writing.total_ns': {'type': MetricType.COUNTER,
-                                                               'unit': 'Microseconds',
-                                                               'parser': nanos_to_micros},
-           'perf.ts.table_insert.entry_trimming.total_ns': {'type': MetricType.COUNTER,
-                                                            'unit': 'Microseconds',
-                                                            'parser': nanos_to_micros},
-           'perf.ts.table_insert.entry_writing.total_ns': {'type': MetricType.COUNTER,
-                                                           'unit': 'Microseconds',
-                                                           'parser': nanos_to_micros},
-           'perf.ts.table_insert.processing.total_ns': {'type': MetricType.COUNTER,
-                                                        'unit': 'Microseconds',
-                                                        'parser': nanos_to_micros},
-           'persistence.bytes_capacity': {'type': MetricType.GAUGE,
-                                          'unit': 'Bytes'},
-           'persistence.bytes_read': {'type': MetricType.COUNTER,
-                                      'unit': 'Bytes'},
-           'persistence.bytes_utilized': {'type': MetricType.GAUGE,
-                                          'unit': 'Bytes'},
-           'persistence.bytes_written': {'type': MetricType.COUNTER,
-                                         'unit': 'Bytes'},
-           'persistence.entries_count': {'type': MetricType.GAUGE,
-                                         'unit': 'Count'},
-           'requests.bytes_out': {'type': MetricType.COUNTER,
-                                  'unit': 'Bytes'},
-           'requests.errors_count': {'type': MetricType.COUNTER,
-                                     'unit': 'Count'},
-           'requests.successes_count': {'type': MetricType.COUNTER,
-                                        'unit': 'Count'},
-           'requests.total_count': {'type': MetricType.COUNTER,
-                                    'unit': 'Count'},
-           'startup': {'type': MetricType.COUNTER,
-                       'unit': 'None'}}
+class Tier(Enum):
+    # Collected every --fast-interval and published at high resolution.
+    FAST = 1
+    # Collected every --interval.
+    NORMAL = 2
+    # Collected every --slow-interval, for values that rarely change.
+    SLOW = 3
+
+class Metric(object):
+    """
+    Immutable description of a statistic. `name` is either an exact statistic
+    name or a pattern, where `*` matches a single dot separated component and
+    `**` matches one or more of them.
+    """
+
+    __slots__ = ('name', 'type', 'unit', 'parser', 'tier')
+
+    def __init__(self, name, type, unit, parser=None, tier=Tier.NORMAL):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'type', type)
+        object.__setattr__(self, 'unit', unit)
+        object.__setattr__(self, 'parser', parser)
+        object.__setattr__(self, 'tier', tier)
+
+    def __setattr__(self, k, v):
+        raise AttributeError("Metric descriptors are immutable")
+
+    def __repr__(self):
+        return "Metric({!r}, {}, {!r})".format(self.name, self.type, self.unit)
+
+    def is_pattern(self):
+        return '*' in self.name
+
+    def sample(self, x):
+        raw = x
+        if self.parser is not None:
+            x = self.parser(x)
+
+        return {'type': self.type,
+                'unit': self.unit,
+                'tier': self.tier,
+                'value': x,
+                'raw': raw}
+
+METRICS = (Metric('cpu.idle', MetricType.COUNTER, 'Microseconds', nanos_to_micros),
+           Metric('cpu.system', MetricType.COUNTER, 'Microseconds', nanos_to_micros),
+           Metric('cpu.user', MetricType.COUNTER, 'Microseconds', nanos_to_micros),
+           Metric('disk.bytes_free', MetricType.GAUGE, 'Bytes', tier=Tier.SLOW),
+           Metric('disk.bytes_total', MetricType.GAUGE, 'Bytes', tier=Tier.SLOW),
+           Metric('disk.path', MetricType.STRING, None),
+           Metric('engine_build_date', MetricType.STRING, None),
+           Metric('engine_version', MetricType.STRING, None),
+           Metric('hardware_concurrency', MetricType.GAUGE, 'Count', tier=Tier.SLOW),
+           Metric('memory.bytes_resident_size', MetricType.GAUGE, 'Bytes'),
+           Metric('memory.physmem.bytes_total', MetricType.GAUGE, 'Bytes'),
+           Metric('memory.physmem.bytes_used', MetricType.GAUGE, 'Bytes'),
+           Metric('memory.resident_count', MetricType.GAUGE, 'Count'),
+           Metric('memory.vm.bytes_total', MetricType.GAUGE, 'Bytes'),
+           Metric('memory.vm.bytes_used', MetricType.GAUGE, 'Bytes'),
+           Metric('network.current_users_count', MetricType.GAUGE, 'Count'),
+           Metric('network.sessions.available_count', MetricType.GAUGE, 'Count'),
+           Metric('network.sessions.max_count', MetricType.GAUGE, 'Count', tier=Tier.SLOW),
+           Metric('network.sessions.unavailable_count', MetricType.GAUGE, 'Count'),
+           Metric('node_id', MetricType.STRING, None),
+           Metric('operating_system', MetricType.STRING, None),
+           Metric('partitions_count', MetricType.GAUGE, 'Count', tier=Tier.SLOW),
+           Metric('persistence.bytes_capacity', MetricType.GAUGE, 'Bytes'),
+           Metric('persistence.bytes_read', MetricType.COUNTER, 'Bytes'),
+           Metric('persistence.bytes_utilized', MetricType.GAUGE, 'Bytes'),
+           Metric('persistence.bytes_written', MetricType.COUNTER, 'Bytes'),
+           Metric('persistence.entries_count', MetricType.GAUGE, 'Count'),
+           Metric('requests.bytes_out', MetricType.COUNTER, 'Bytes'),
+           Metric('requests.errors_count', MetricType.COUNTER, 'Count'),
+           Metric('requests.successes_count', MetricType.COUNTER, 'Count'),
+           Metric('requests.total_count', MetricType.COUNTER, 'Count'),
+           Metric('startup', MetricType.COUNTER, 'None'),
+
+           # Cumulative time spent in each stage of each operation, e.g.
+           # perf.ts.table_insert.entry_writing.total_ns. Patterns are tried
+           # in order, so the latency critical inserts come first.
+           Metric('perf.ts.table_insert.*.total_ns', MetricType.COUNTER, 'Microseconds', nanos_to_micros, tier=Tier.FAST),
+           Metric('perf.**.total_ns', MetricType.COUNTER, 'Microseconds', nanos_to_micros))
+
+def pattern_to_regex(pattern):
+    parts = []
+    for x in pattern.split('.'):
+        if x == '**':
+            parts.append(r'[^.]+(?:\.[^.]+)*')
+        elif x == '*':
+            parts.append(r'[^.]+')
+        else:
+            parts.append(re.escape(x))
+
+    return r'\.'.join(parts)
+
+class Registry(object):
+    """
+    Resolves statistic names to their Metric descriptor. Exact names are
+    looked up directly; patterns are compiled into a single regular
+    expression tried in declaration order. Every resolution, including
+    misses, is memoized so each statistic is classified only once.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = tuple(metrics)
+
+        self._exact = dict()
+        self._patterns = []
+        for m in self.metrics:
+            if m.is_pattern():
+                self._patterns.append(m)
+            else:
+                self._exact[m.name] = m
+
+        self._regex = None
+        if self._patterns:
+            self._regex = re.compile('|'.join('(?P<p{}>{})'.format(i, pattern_to_regex(m.name))
+                                              for (i, m) in enumerate(self._patterns)))
+
+        self._lock = threading.Lock()
+        self._cache = dict()
+
+    def _resolve(self, x):
+        m = self._exact.get(x)
+        if m is not None or self._regex is None:
+            return m
+
+        match = self._regex.fullmatch(x)
+        if match is None:
+            return None
+
+        return self._patterns[int(match.lastgroup[1:])]
+
+    def resolve(self, x):
+        try:
+            return self._cache[x]
+        except KeyError:
+            pass
+
+        m = self._resolve(x)
+
+        with self._lock:
+            if x not in self._cache and m is None:
+                print("unrecognized key: ", x, file=sys.stderr)
+            self._cache[x] = m
+
+        return m
+
+REGISTRY = Registry(METRICS)
 
 def key_to_metric(x):
-    try:
-        return METRICS[x]
-    except KeyError:
-        print("unrecognized key: ", x)
+    return REGISTRY.resolve(x)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from concurrent.futures import Future
+
+# Current PutMetricData limits: at most 1000 datums and 1MB of request
+# payload per call.
+MAX_DATUMS = 1000
+MAX_BYTES = 1000 * 1000
+
+# Requests are sent form-encoded, which repeats the member path of every
+# field; this is a conservative factor over the compact JSON size of a datum.
+ENCODING_OVERHEAD = 2
+
+THROTTLING_CODES = frozenset(['Throttling',
+                              'ThrottlingException',
+                              'RequestLimitExceeded',
+                              'TooManyRequestsException'])
+
+def datum_size(datum):
+    return len(json.dumps(datum, separators=(',', ':'), default=str)) * ENCODING_OVERHEAD
+
+def batches(datums, max_datums=MAX_DATUMS, max_bytes=MAX_BYTES):
+    batch = []
+    size = 0
+    for datum in datums:
+        n = datum_size(datum)
+        if batch and (len(batch) >= max_datums or size + n > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+
+        batch.append(datum)
+        size += n
+
+    if batch:
+        yield batch
+
+def is_retryable(e):
+    response = getattr(e, 'response', None) or dict()
+    code = response.get('Error', dict()).get('Code')
+    status = response.get('ResponseMetadata', dict()).get('HTTPStatusCode')
+
+    if code in THROTTLING_CODES:
+        return True
+    if status is not None and status >= 500:
+        return True
+
+    # botocore's connection and timeout errors do not derive from the
+    # builtin ConnectionError, so recognise them by name.
+    name = type(e).__name__
+    return (isinstance(e, (ConnectionError, TimeoutError)) or
+            name.endswith('ConnectionError') or
+            name.endswith('TimeoutError'))
+
+def backoff(attempt, base=0.2, cap=20.0):
+    # "Full jitter": a uniformly random wait up to the exponential bound.
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class PublishResult(object):
+    def __init__(self):
+        self.batches = 0
+        self.datums = 0
+        self.failed = []
+
+    def add(self, batch, error=None):
+        if error is None:
+            self.batches += 1
+            self.datums += len(batch)
+        else:
+            self.failed.append((batch, error))
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def __repr__(self):
+        return ("published {} datums in {} batches, {} batches failed"
+                .format(self.datums, self.batches, len(self.failed)))
+
+class Publisher(object):
+    """
+    Sends PutMetricData batches through a bounded queue drained by a small
+    pool of sender threads. Throttled and transient failures are retried with
+    exponential backoff; a batch that keeps failing is reported in the
+    PublishResult rather than aborting the remaining batches.
+    """
+
+    def __init__(self, client, namespace, senders=4, queue_size=16, retries=5,
+                 max_datums=MAX_DATUMS, max_bytes=MAX_BYTES, instruments=None):
+        if senders < 1:
+            raise ValueError("A publisher needs at least one sender, got: " + str(senders))
+
+        self.client = client
+        self.namespace = namespace
+        self.retries = retries
+        self.instruments = instruments
+        self.max_datums = max_datums
+        self.max_bytes = max_bytes
+
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        for i in range(senders):
+            t = threading.Thread(target=self._run, name='qdb-cloudwatch-sender-' + str(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _send(self, namespace, batch):
+        attempt = 0
+        while True:
+            try:
+                if self.instruments is not None:
+                    self.instruments.incr('api_calls')
+
+                return self.client.put_metric_data(Namespace=namespace,
+                                                   MetricData=batch)
+            except Exception as e:
+                if self.instruments is not None:
+                    self.instruments.incr('api_errors')
+
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+                time.sleep(backoff(attempt))
+                attempt += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            (namespace, batch, future) = item
+            try:
+                future.set_result(self._send(namespace, batch))
+            except Exception as e:
+                future.set_exception(e)
+
+    def submit(self, datums, namespace=None):
+        if namespace is None:
+            namespace = self.namespace
+
+        # Blocks while the queue is full, which bounds the memory held by
+        # batches waiting to be sent.
+        xs = []
+        with self._lock:
+            # Nothing would ever send a batch queued behind the senders'
+            # stop sentinels.
+            if self._closed:
+                raise RuntimeError("Publisher is closed")
+
+            for batch in batches(datums, self.max_datums, self.max_bytes):
+                future = Future()
+                self._queue.put((namespace, batch, future))
+                xs.append((batch, future))
+
+        return xs
+
+    def publish(self, datums, namespace=None):
+        result = PublishResult()
+        for (batch, future) in self.submit(datums, namespace):
+            try:
+                future.result()
+                result.add(batch)
+            except Exception as e:
+                print("unable to publish batch of ", len(batch), " metrics: ", e, file=sys.stderr)
+                result.add(batch, e)
+
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+
+        for t in self._threads:
+            t.join()
+
+        self._threads = []
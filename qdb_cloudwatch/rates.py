@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from .metrics import MetricType
+from .state import load_state
+from .state import save_state
+
+RAW = 'raw'
+RATE = 'rate'
+DELTA = 'delta'
+
+MODES = [RAW, RATE, DELTA]
+
+# CloudWatch only knows a handful of per-second units; everything else is
+# published unitless once turned into a rate.
+RATE_UNITS = {'Bytes': 'Bytes/Second',
+              'Count': 'Count/Second'}
+
+# The startup statistic changes whenever the node restarts, which resets
+# every counter.
+STARTUP = 'startup'
+
+def is_counter(metric):
+    return metric['type'].value is MetricType.COUNTER.value
+
+class CounterTracker(object):
+    """
+    Turns cumulative counters into per-second rates or per-interval deltas
+    by remembering the previous sample of every counter of every node.
+    Counters may be collected at different intervals, so each keeps its own
+    timestamp. Nothing is published for a counter until a second sample is
+    available, and samples taken across a restart or a counter going
+    backwards are discarded.
+    """
+
+    def __init__(self, mode=RATE, path=None):
+        self.mode = mode
+        self.path = path
+        self._nodes = load_state(path) or dict()
+
+    def convert(self, node_id, metrics, now=None):
+        if self.mode == RAW:
+            return metrics
+
+        if now is None:
+            now = time.time()
+
+        startup = metrics[STARTUP]['value'] if STARTUP in metrics else None
+        prev = self._nodes.get(node_id)
+        if prev is None or prev['startup'] != startup:
+            prev = {'startup': startup,
+                    'values': dict()}
+            self._nodes[node_id] = prev
+
+        res = dict()
+        for (k, metric) in metrics.items():
+            if k == STARTUP or not is_counter(metric):
+                res[k] = metric
+                continue
+
+            last = prev['values'].get(k)
+            prev['values'][k] = [metric['value'], now]
+
+            if last is None:
+                continue
+
+            delta = metric['value'] - last[0]
+            elapsed = now - last[1]
+            if delta < 0 or elapsed <= 0:
+                continue
+
+            if self.mode == RATE:
+                res[k] = dict(metric,
+                              value=delta / elapsed,
+                              unit=RATE_UNITS.get(metric['unit'], 'None'))
+            else:
+                res[k] = dict(metric, value=delta)
+
+        return res
+
+    def save(self):
+        save_state(self.path, self._nodes)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fixed-size ring buffer of raw samples, kept in memory-mapped NumPy files so
+the history survives restarts and can be inspected after an incident:
+
+    qdb-cloudwatch-ring export --ring-dir DIR --start 2026-10-18T10:00 --output samples.csv
+    qdb-cloudwatch-ring replay --ring-dir DIR --start 2026-10-18T10:00 --end 2026-10-18T11:00
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import sys
+
+import numpy as np
+
+from .metrics import key_to_metric
+from .metrics import MetricType
+from .metrics import REGISTRY
+from .state import load_state
+from .state import save_state
+
+DATA = 'samples.npy'
+CURSORS = 'cursors.npy'
+INDEX = 'index.json'
+
+# Column of the last axis of the sample array.
+TS = 0
+VALUE = 1
+
+class RingBuffer(object):
+    """
+    Keeps the last `capacity` collections of up to `max_metrics` statistics
+    for up to `max_nodes` nodes. Samples are stored as (timestamp in
+    nanoseconds, raw int64 value) pairs in an array of shape (nodes,
+    metrics, capacity, 2); a slot with a zero timestamp holds no sample.
+
+    Node and metric slots are assigned on first sight and recorded in an
+    index file. Metric slots start from the registry's exact statistics, so
+    their order is the same for every buffer.
+    """
+
+    def __init__(self, directory, capacity=1440, max_nodes=8, max_metrics=256, readonly=False):
+        self.directory = directory
+        index_path = os.path.join(directory, INDEX)
+        data_path = os.path.join(directory, DATA)
+        cursors_path = os.path.join(directory, CURSORS)
+
+        self.index = load_state(index_path)
+        mode = 'r' if readonly else 'r+'
+
+        if self.index is None:
+            if readonly:
+                raise IOError("No ring buffer in " + directory)
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            names = [m.name for m in REGISTRY.metrics
+                     if not m.is_pattern() and m.type.value is not MetricType.STRING.value]
+            self.index = {'capacity': capacity,
+                          'max_nodes': max_nodes,
+                          'max_metrics': max_metrics,
+                          'nodes': [],
+                          'metrics': names[:max_metrics]}
+
+            np.lib.format.open_memmap(data_path, mode='w+', dtype=np.int64,
+                                      shape=(max_nodes, max_metrics, capacity, 2)).flush()
+            np.lib.format.open_memmap(cursors_path, mode='w+', dtype=np.int64,
+                                      shape=(max_nodes,)).flush()
+            save_state(index_path, self.index)
+
+        self._index_path = index_path
+        self.data = np.load(data_path, mmap_mode=mode)
+        self.cursors = np.load(cursors_path, mmap_mode=mode)
+
+        self._nodes = dict((x, i) for (i, x) in enumerate(self.index['nodes']))
+        self._metrics = dict((x, i) for (i, x) in enumerate(self.index['metrics']))
+        self._warned = set()
+        self._dirty = False
+
+        # (node, statistic names) -> (slot indices, mask of names with a
+        # slot); tiers make the set of names vary from one cycle to the next.
+        self._slots = dict()
+
+    def _slot(self, slots, names, name, limit):
+        i = slots.get(name)
+        if i is not None:
+            return i
+
+        if len(names) >= limit:
+            if name not in self._warned:
+                self._warned.add(name)
+                print("ring buffer full, not recording ", name, file=sys.stderr)
+            return None
+
+        i = slots[name] = len(names)
+        names.append(name)
+        self._dirty = True
+
+        return i
+
+    def _save_index(self):
+        if self._dirty:
+            save_state(self._index_path, self.index)
+            self._dirty = False
+
+    def write(self, node_id, metrics, timestamp):
+        node = self._slot(self._nodes, self.index['nodes'], node_id, self.index['max_nodes'])
+        if node is None:
+            return
+
+        names = tuple(k for (k, metric) in metrics.items() if 'raw' in metric)
+        cached = self._slots.get((node, names))
+        if cached is None:
+            xs = [self._slot(self._metrics, self.index['metrics'], k, self.index['max_metrics'])
+                  for k in names]
+            cached = self._slots[(node, names)] = (np.array([i for i in xs if i is not None], dtype=np.intp),
+                                                   np.array([i is not None for i in xs], dtype=bool))
+        self._save_index()
+
+        (slots, mask) = cached
+        values = np.fromiter((metrics[k]['raw'] for k in names), dtype=np.int64, count=len(names))
+
+        c = int(self.cursors[node])
+
+        # One store per column into the mapped pages; statistics missing
+        # from this collection are cleared so stale values are never read
+        # back.
+        self.data[node, :, c, TS] = 0
+        self.data[node, slots, c, TS] = int(timestamp * 1e9)
+        self.data[node, slots, c, VALUE] = values[mask]
+
+        self.cursors[node] = (c + 1) % self.index['capacity']
+
+    def flush(self):
+        self.data.flush()
+        self.cursors.flush()
+
+    def read(self, start=None, end=None):
+        """
+        Yields (node_id, timestamp, {metric: raw value}) for every collection
+        between `start` and `end`, epoch seconds, oldest first per node.
+        """
+        capacity = self.index['capacity']
+        lo = 0 if start is None else int(start * 1e9)
+        hi = np.iinfo(np.int64).max if end is None else int(end * 1e9)
+
+        for (node, node_id) in enumerate(self.index['nodes']):
+            c = int(self.cursors[node])
+            for j in range(capacity):
+                slot = (c + j) % capacity
+                ts = self.data[node, :, slot, TS]
+                present = np.flatnonzero((ts >= max(lo, 1)) & (ts <= hi))
+                if len(present) == 0:
+                    continue
+
+                values = dict((self.index['metrics'][i], int(self.data[node, i, slot, VALUE]))
+                              for i in present)
+                yield (node_id, int(ts[present].max()) / 1e9, values)
+
+def _parse_time(x):
+    if x is None:
+        return None
+    try:
+        return float(x)
+    except ValueError:
+        t = datetime.datetime.fromisoformat(x)
+
+    # Times without an explicit offset are UTC.
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.timestamp()
+
+def _isoformat(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat()
+
+def export(ring, start, end, path, fmt):
+    rows = [(_isoformat(ts), node_id, k, v)
+            for (node_id, ts, values) in ring.read(start, end)
+            for (k, v) in sorted(values.items())]
+
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("parquet export requires pyarrow")
+
+        columns = list(zip(*rows)) if rows else [[], [], [], []]
+        table = pyarrow.table({'timestamp': list(columns[0]),
+                               'node_id': list(columns[1]),
+                               'metric': list(columns[2]),
+                               'value': list(columns[3])})
+        pyarrow.parquet.write_table(table, path)
+        return len(rows)
+
+    f = sys.stdout if path in (None, '-') else open(path, 'w', newline='')
+    try:
+        w = csv.writer(f)
+        w.writerow(['timestamp', 'node_id', 'metric', 'value'])
+        w.writerows(rows)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    return len(rows)
+
+def replay(ring, start, end, args):
+    # Imported here: the exporter pulls in far more than exporting needs.
+    from .exporter import get_cloudwatch_client
+    from .exporter import put_metrics
+    from .publisher import Publisher
+    from .rates import CounterTracker
+
+    client = get_cloudwatch_client(args.region_name, args.aws_client)
+    sink = Publisher(client, args.namespace)
+    counters = CounterTracker(args.counter_mode)
+
+    try:
+        n = 0
+        for (node_id, ts, values) in ring.read(start, end):
+            metrics = dict()
+            for (k, v) in values.items():
+                metric = key_to_metric(k)
+                if metric is not None:
+                    metrics[k] = metric.sample(v)
+
+            metrics = counters.convert(node_id, metrics, ts)
+            result = put_metrics(client, args.namespace, metrics, args.instance_id,
+                                 node_id if args.node_dimension else None,
+                                 sink, ts)
+            n += result.datums
+
+        return n
+    finally:
+        sink.close()
+
+def get_args():
+    from .rates import MODES as COUNTER_MODES
+    from .rates import RATE
+
+    parser = argparse.ArgumentParser(
+        description='Export or replay the raw samples recorded by qdb-cloudwatch --ring-dir.')
+    parser.add_argument('command', choices=['export', 'replay'])
+    parser.add_argument('--ring-dir', dest='ring_dir', required=True,
+                        help='Ring buffer directory, as given to qdb-cloudwatch --ring-dir.')
+    parser.add_argument('--start', help='Start of the range, epoch seconds or ISO 8601 time, UTC unless an offset is given. Defaults to the oldest sample.')
+    parser.add_argument('--end', help='End of the range, epoch seconds or ISO 8601 time, UTC unless an offset is given. Defaults to the newest sample.')
+    parser.add_argument('--format', dest='fmt', choices=['csv', 'parquet'], default='csv',
+                        help='Export format. Defaults to csv.')
+    parser.add_argument('--output', help='Export file. Defaults to stdout for csv.')
+    parser.add_argument('--namespace', default='QuasarDB',
+                        help='Cloudwatch namespace to replay into. Defaults to \'QuasarDB\'')
+    parser.add_argument('--instance-id', dest='instance_id',
+                        help='EC2 instance id to add to the dimensions of replayed metrics.')
+    parser.add_argument('--node-dimension', dest='node_dimension', action='store_true',
+                        help='Add a NodeId dimension to replayed metrics, as qdb-cloudwatch --all-nodes does.')
+    parser.add_argument('--counters', dest='counter_mode', choices=COUNTER_MODES, default=RATE,
+                        help='How replayed counters are published. Defaults to \'rate\'.')
+    parser.add_argument('--region', dest='region_name',
+                        help='AWS region to replay metrics in. Defaults to $AWS_DEFAULT_REGION.')
+    parser.add_argument('--aws-client', dest='aws_client', choices=['boto3', 'builtin'], default='boto3',
+                        help='CloudWatch client to replay with. Defaults to \'boto3\'.')
+
+    args = parser.parse_args()
+    if args.command == 'export' and args.fmt == 'parquet' and args.output is None:
+        parser.error('parquet export requires --output')
+
+    return args
+
+def main():
+    args = get_args()
+    ring = RingBuffer(args.ring_dir, readonly=True)
+    start = _parse_time(args.start)
+    end = _parse_time(args.end)
+
+    if args.command == 'export':
+        n = export(ring, start, end, args.output, args.fmt)
+        print("exported ", n, " samples", file=sys.stderr)
+    else:
+        n = replay(ring, start, end, args)
+        print("replayed ", n, " datums", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+
+from .rates import STARTUP
+from .rates import is_counter
+
+BOTH = 'both'
+ONLY = 'only'
+NONE = 'none'
+
+MODES = [NONE, BOTH, ONLY]
+
+DEFAULT_COUNTER_AGGREGATES = ['sum']
+DEFAULT_GAUGE_AGGREGATES = ['min', 'max', 'p50', 'p90', 'p99']
+
+_REDUCERS = {'sum': 'nansum',
+             'mean': 'nanmean',
+             'min': 'nanmin',
+             'max': 'nanmax'}
+
+def _percentile(aggregate):
+    if not aggregate.startswith('p'):
+        return None
+
+    try:
+        q = float(aggregate[1:])
+    except ValueError:
+        return None
+
+    return q if 0 <= q <= 100 else None
+
+def validate(aggregate):
+    if aggregate not in _REDUCERS and _percentile(aggregate) is None:
+        raise ValueError("Invalid aggregate: " + aggregate)
+
+def reducer(aggregate):
+    import numpy as np
+
+    validate(aggregate)
+    if aggregate in _REDUCERS:
+        return getattr(np, _REDUCERS[aggregate])
+
+    q = _percentile(aggregate)
+    return lambda m, axis: np.nanpercentile(m, q, axis=axis)
+
+def _scalar(metric):
+    return 'value' in metric and 'statistics' not in metric and 'values' not in metric
+
+def rollup(nodes, counter_aggregates=DEFAULT_COUNTER_AGGREGATES,
+           gauge_aggregates=DEFAULT_GAUGE_AGGREGATES):
+    """
+    Aggregates every metric across `nodes`, a list of (node_id, metrics)
+    tuples, returning a list of (aggregate, metrics) tuples. Counters are
+    reduced with `counter_aggregates` and everything else with
+    `gauge_aggregates`; nodes missing a metric are ignored. `startup`, a
+    node's start time, is not aggregated.
+    """
+    import numpy as np
+
+    descriptors = dict()
+    for (_, metrics) in nodes:
+        for (k, metric) in metrics.items():
+            if k != STARTUP and _scalar(metric) and k not in descriptors:
+                descriptors[k] = metric
+
+    names = sorted(descriptors)
+    index = dict((k, i) for (i, k) in enumerate(names))
+
+    matrix = np.full((len(nodes), len(names)), np.nan)
+    for (i, (_, metrics)) in enumerate(nodes):
+        for (k, metric) in metrics.items():
+            if k in index and _scalar(metric):
+                matrix[i, index[k]] = metric['value']
+
+    counters = [i for (i, k) in enumerate(names) if is_counter(descriptors[k])]
+    gauges = [i for (i, k) in enumerate(names) if not is_counter(descriptors[k])]
+
+    res = []
+    for (columns, aggregates) in ((counters, counter_aggregates), (gauges, gauge_aggregates)):
+        if not columns or len(nodes) == 0:
+            continue
+
+        m = matrix[:, columns]
+        for aggregate in aggregates:
+            # Columns with no value on any node reduce to NaN, with a
+            # warning we do not care about: they are dropped below.
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                ys = reducer(aggregate)(m, axis=0)
+
+            # nansum of an all-NaN column is 0; do not report those.
+            present = np.any(~np.isnan(m), axis=0)
+
+            xs = dict()
+            for j in np.flatnonzero(present & np.isfinite(ys)):
+                k = names[columns[j]]
+                xs[k] = dict(descriptors[k], value=float(ys[j]))
+
+            if xs:
+                res.append((aggregate, xs))
+
+    return res
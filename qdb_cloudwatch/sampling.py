@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import threading
+
+from collections import Counter
+
+from .rates import RATE_UNITS
+from .rates import is_counter
+
+STATS = 'stats'
+VALUES = 'values'
+
+MODES = [STATS, VALUES]
+
+DEFAULT_PATTERNS = ['perf.ts.table_insert.*', 'network.sessions.*']
+
+# PutMetricData accepts at most 150 distinct values per Values array.
+MAX_VALUES = 150
+
+class StatisticSet(object):
+    __slots__ = ('minimum', 'maximum', 'total', 'count')
+
+    def __init__(self):
+        self.minimum = None
+        self.maximum = None
+        self.total = 0
+        self.count = 0
+
+    def add(self, x):
+        self.minimum = x if self.minimum is None else min(self.minimum, x)
+        self.maximum = x if self.maximum is None else max(self.maximum, x)
+        self.total += x
+        self.count += 1
+
+    def to_statistic_values(self):
+        return {'Minimum': self.minimum,
+                'Maximum': self.maximum,
+                'Sum': self.total,
+                'SampleCount': self.count}
+
+class Sampler(object):
+    """
+    Aggregates high frequency samples of the metrics matching `patterns`
+    over a publishing window, so each metric is published once per window
+    with its min/max/sum/count (or distinct values and their counts) instead
+    of a single point. Counters are aggregated as per-second rates between
+    consecutive samples.
+    """
+
+    def __init__(self, patterns=DEFAULT_PATTERNS, mode=STATS):
+        self.patterns = patterns
+        self.mode = mode
+
+        self._lock = threading.Lock()
+        self._windows = dict()
+        self._last = dict()
+        self._latest = dict()
+
+    def matches(self, name):
+        return any(fnmatch.fnmatchcase(name, p) for p in self.patterns)
+
+    def add(self, node_id, metrics, now):
+        with self._lock:
+            for (k, metric) in metrics.items():
+                self._latest[(node_id, k)] = metric
+                x = metric['value']
+
+                if is_counter(metric):
+                    prev = self._last.get((node_id, k))
+                    self._last[(node_id, k)] = (x, now)
+
+                    if prev is None or x < prev[0] or now <= prev[1]:
+                        continue
+
+                    x = (x - prev[0]) / (now - prev[1])
+
+                window = self._windows.get((node_id, k))
+                if window is None:
+                    window = self._windows[(node_id, k)] = (metric, StatisticSet(), Counter())
+
+                window[1].add(x)
+                if self.mode == VALUES:
+                    window[2][x] += 1
+
+    def owned(self, node_id):
+        """
+        Returns the metrics of `node_id` with a sample waiting to be taken
+        by latest(), which need not be collected again.
+        """
+        with self._lock:
+            return set(k for (n, k) in self._latest if n == node_id)
+
+    def latest(self, node_id):
+        """
+        Removes and returns the most recent sample of each metric of
+        `node_id`, as collected, to stand in for a regular collection.
+        """
+        with self._lock:
+            ks = [k for (n, k) in self._latest if n == node_id]
+            return dict((k, self._latest.pop((node_id, k))) for k in ks)
+
+    def merge(self, node_id, metrics):
+        """
+        Adds the aggregate of the window that just ended for `node_id` to
+        `metrics`, replacing their single point values, and starts a new
+        window.
+        """
+        res = dict(metrics)
+
+        with self._lock:
+            ks = [k for (n, k) in self._windows if n == node_id]
+            for k in ks:
+                (metric, stats, values) = self._windows.pop((node_id, k))
+                unit = metric['unit']
+                if is_counter(metric):
+                    unit = RATE_UNITS.get(unit, 'None')
+
+                if self.mode == VALUES and len(values) <= MAX_VALUES:
+                    res[k] = dict(metric,
+                                  unit=unit,
+                                  values=list(values.keys()),
+                                  counts=list(values.values()))
+                else:
+                    res[k] = dict(metric,
+                                  unit=unit,
+                                  statistics=stats.to_statistic_values())
+
+        return res
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import signal
+import threading
+import time
+
+def install_signal_handlers(stop):
+    def _handler(signum, frame):
+        stop.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _handler)
+
+def next_deadline(deadline, interval, now):
+    deadline += interval
+
+    # A cycle that ran longer than the interval skips the ticks it missed
+    # rather than firing them back to back, so we stay on the original grid.
+    if deadline <= now:
+        missed = int((now - deadline) // interval) + 1
+        deadline += missed * interval
+
+    return deadline
+
+def run_every(interval, fn, stop=None):
+    if stop is None:
+        stop = threading.Event()
+
+    deadline = time.monotonic()
+    while not stop.is_set():
+        fn()
+
+        now = time.monotonic()
+        deadline = next_deadline(deadline, interval, now)
+        stop.wait(deadline - now)
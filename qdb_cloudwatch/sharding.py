@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import hashlib
+
+# Points each shard owns on the ring; more points spread nodes more evenly.
+REPLICAS = 128
+
+def _hash(x):
+    # Python's hash() is salted per process, replicas need a stable one.
+    return int(hashlib.md5(x.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    Consistent hash ring assigning node ids to `count` shards. Going from N
+    to N+1 shards only moves about 1/(N+1) of the nodes.
+    """
+
+    def __init__(self, count, replicas=REPLICAS):
+        self.count = count
+
+        points = []
+        for shard in range(count):
+            for i in range(replicas):
+                points.append((_hash('{}-{}'.format(shard, i)), shard))
+
+        points.sort()
+        self._keys = [x for (x, _) in points]
+        self._shards = [x for (_, x) in points]
+
+    def owner(self, node_id):
+        i = bisect.bisect(self._keys, _hash(node_id)) % len(self._keys)
+        return self._shards[i]
+
+def shard(node_ids, index, count):
+    if count <= 1:
+        return list(node_ids)
+
+    ring = HashRing(count)
+    return [x for x in node_ids if ring.owner(x) == index]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+
+from .publisher import PublishResult
+
+CLOUDWATCH = 'cloudwatch'
+EMF = 'emf'
+
+SINKS = [CLOUDWATCH, EMF]
+
+# Embedded Metric Format limits: at most 100 metrics per directive, 30
+# dimensions per dimension set and 100 values per metric.
+EMF_MAX_METRICS = 100
+EMF_MAX_DIMENSIONS = 30
+EMF_MAX_VALUES = 100
+
+def _emf_value(datum):
+    # EMF has no notion of statistic sets; reporting them as values would
+    # give CloudWatch the wrong sample count, sum and average.
+    if 'StatisticValues' in datum:
+        raise ValueError("Statistic sets cannot be written as EMF: " + datum['MetricName'])
+
+    if 'Values' in datum:
+        counts = datum.get('Counts') or [1] * len(datum['Values'])
+        xs = []
+        for (x, n) in zip(datum['Values'], counts):
+            xs.extend([x] * int(n))
+        return xs[:EMF_MAX_VALUES]
+
+    return datum['Value']
+
+def emf_lines(namespace, datums):
+    """
+    Renders PutMetricData datums as Embedded Metric Format objects, one per
+    distinct dimension set and timestamp, each holding at most
+    EMF_MAX_METRICS metrics. Datums may carry extra Properties, which are
+    added to their object as is.
+    """
+    # Datums without a timestamp share one, and so one object.
+    now = time.time()
+    groups = dict()
+    for datum in datums:
+        dimensions = tuple((x['Name'], x['Value'])
+                           for x in datum.get('Dimensions', [])[:EMF_MAX_DIMENSIONS])
+        timestamp = datum.get('Timestamp', now)
+        groups.setdefault((dimensions, timestamp), []).append(datum)
+
+    for ((dimensions, timestamp), xs) in groups.items():
+        for i in range(0, len(xs), EMF_MAX_METRICS):
+            chunk = xs[i:i + EMF_MAX_METRICS]
+
+            metrics = []
+            for datum in chunk:
+                metric = {'Name': datum['MetricName']}
+                if datum.get('Unit') is not None:
+                    metric['Unit'] = datum['Unit']
+                if datum.get('StorageResolution') is not None:
+                    metric['StorageResolution'] = datum['StorageResolution']
+                metrics.append(metric)
+
+            obj = {'_aws': {'Timestamp': int(timestamp * 1000),
+                            'CloudWatchMetrics': [{'Namespace': namespace,
+                                                   'Dimensions': [[k for (k, _) in dimensions]],
+                                                   'Metrics': metrics}]}}
+            obj.update(chunk[0].get('Properties', dict()))
+            obj.update(dimensions)
+            for datum in chunk:
+                obj[datum['MetricName']] = _emf_value(datum)
+
+            yield json.dumps(obj, separators=(',', ':'), default=str)
+
+class EmfSink(object):
+    """
+    Writes metrics as Embedded Metric Format JSON lines, to stdout or to a
+    size-rotated file, for the CloudWatch agent to pick up. Exposes the same
+    publish() as Publisher so either can back put_metrics.
+    """
+
+    def __init__(self, namespace, path=None, max_bytes=64 * 1024 * 1024, backup_count=2):
+        self.namespace = namespace
+
+        if path is None or path == '-':
+            self._handler = logging.StreamHandler(sys.stdout)
+        else:
+            self._handler = logging.handlers.RotatingFileHandler(path,
+                                                                 maxBytes=max_bytes,
+                                                                 backupCount=backup_count)
+
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._lock = threading.Lock()
+
+    def _write(self, line):
+        self._handler.emit(logging.makeLogRecord({'msg': line,
+                                                  'levelno': logging.INFO,
+                                                  'levelname': 'INFO'}))
+
+    def publish(self, datums, namespace=None):
+        if namespace is None:
+            namespace = self.namespace
+
+        result = PublishResult()
+        with self._lock:
+            for line in emf_lines(namespace, datums):
+                self._write(line)
+
+        result.add(datums)
+        return result
+
+    def close(self):
+        self._handler.close()
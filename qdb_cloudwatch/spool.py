@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import threading
+import time
+
+# CloudWatch rejects datums timestamped more than two weeks in the past.
+MAX_AGE = 14 * 24 * 3600
+
+SEGMENT_PREFIX = 'spool-'
+SEGMENT_SUFFIX = '.jsonl'
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class Spool(object):
+    """
+    Append-only on-disk spool of batches that could not be published. Batches
+    are written as compact JSON lines into numbered segment files; once the
+    spool exceeds `max_bytes` the oldest segments are evicted first.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory,
+                            '{}{:012d}{}'.format(SEGMENT_PREFIX, seq, SEGMENT_SUFFIX))
+
+    def segments(self):
+        xs = [x for x in os.listdir(self.directory)
+              if x.startswith(SEGMENT_PREFIX) and x.endswith(SEGMENT_SUFFIX)]
+        return [os.path.join(self.directory, x) for x in sorted(xs)]
+
+    def _seq(self, path):
+        return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _evict(self, segments):
+        sizes = [os.path.getsize(x) for x in segments]
+        total = sum(sizes)
+
+        while segments and total > self.max_bytes:
+            print("spool full, dropping ", segments[0], file=sys.stderr)
+            _remove(segments[0])
+            total -= sizes[0]
+            segments = segments[1:]
+            sizes = sizes[1:]
+
+    def append(self, namespace, batch):
+        now = time.time()
+        datums = []
+        for datum in batch:
+            if 'Timestamp' not in datum:
+                datum = dict(datum, Timestamp=now)
+            datums.append(datum)
+
+        line = json.dumps({'ns': namespace, 'd': datums}, separators=(',', ':'), default=str)
+
+        with self._lock:
+            segments = self.segments()
+            if segments and os.path.getsize(segments[-1]) < self.segment_bytes:
+                path = segments[-1]
+            else:
+                path = self._segment_path(self._seq(segments[-1]) + 1 if segments else 0)
+                segments.append(path)
+
+            with open(path, 'a+b') as f:
+                # Never glue a record onto a line torn by an earlier crash.
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        line = '\n' + line
+                f.write((line + '\n').encode('utf-8'))
+
+            self._evict(segments)
+
+    def empty(self):
+        with self._lock:
+            return not self.segments()
+
+    def drain(self, publish, rate=5.0, stop=None, limit=None):
+        """
+        Replays spooled batches oldest first through `publish(namespace,
+        datums)`, which returns whether the batch was sent, sending at most
+        `rate` batches per second and at most `limit` batches in total. Stops
+        at the first failure, leaving the remaining batches in place; returns
+        the number of batches replayed.
+        """
+        n = 0
+
+        while stop is None or not stop.is_set():
+            with self._lock:
+                segments = self.segments()
+                if not segments:
+                    return n
+
+                path = segments[0]
+                with open(path, 'r') as f:
+                    lines = [x for x in f if x.strip()]
+
+                if not lines:
+                    _remove(path)
+                    continue
+
+                # Make sure nothing is appended to the segment we are
+                # replaying, so it can be rewritten or removed safely.
+                if len(segments) == 1:
+                    open(self._segment_path(self._seq(path) + 1), 'a').close()
+
+            try:
+                while lines:
+                    try:
+                        record = json.loads(lines[0])
+                    except ValueError:
+                        # A crash mid-append can leave a torn line behind.
+                        print("skipping unreadable spool record in ", path, file=sys.stderr)
+                        lines = lines[1:]
+                        continue
+
+                    cutoff = time.time() - MAX_AGE
+                    datums = [x for x in record['d'] if x['Timestamp'] >= cutoff]
+
+                    if datums and not publish(record['ns'], datums):
+                        self._rewrite(path, lines)
+                        return n
+
+                    lines = lines[1:]
+                    n += 1
+
+                    if limit is not None and n >= limit:
+                        self._rewrite(path, lines)
+                        return n
+
+                    if stop is not None and stop.wait(1.0 / rate):
+                        self._rewrite(path, lines)
+                        return n
+                    elif stop is None:
+                        time.sleep(1.0 / rate)
+            except BaseException:
+                # Keep what was already replayed from being sent again.
+                self._rewrite(path, lines)
+                raise
+
+            with self._lock:
+                _remove(path)
+
+        return n
+
+    def _rewrite(self, path, lines):
+        with self._lock:
+            if not lines:
+                _remove(path)
+                return
+
+            # The segment may have been evicted while it was replayed.
+            if not os.path.exists(path):
+                return
+
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines(lines)
+            os.replace(tmp, path)
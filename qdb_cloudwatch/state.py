@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import tempfile
+
+def state_path(state_dir, name):
+    if state_dir is None:
+        return None
+    return os.path.join(state_dir, name)
+
+def load_state(path):
+    if path is None or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        print("ignoring unreadable state file ", path, ": ", e, file=sys.stderr)
+        return None
+
+def save_state(path, obj):
+    if path is None:
+        return
+
+    # Write to a temporary file next to the target and rename it in place, so
+    # a crash mid-write never leaves a truncated state file behind.
+    try:
+        d = os.path.dirname(path) or '.'
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.' + os.path.basename(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, separators=(',', ':'))
+        os.replace(tmp, path)
+    except (IOError, OSError) as e:
+        print("unable to write state file ", path, ": ", e, file=sys.stderr)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from .rates import STARTUP
+from .state import load_state
+from .state import save_state
+
+def decode(x):
+    if isinstance(x, bytes):
+        x = x.decode('utf-8', 'replace')
+    return x.rstrip('\0')
+
+def dimension_name(name):
+    # engine_version -> EngineVersion, disk.path -> DiskPath
+    return ''.join(x.capitalize() for x in name.replace('.', '_').split('_'))
+
+class StringCache(object):
+    """
+    Caches the string statistics of each node, e.g. engine_version. They only
+    change when a node restarts, so they are fetched again only when the
+    node's startup statistic changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._nodes = load_state(path) or dict()
+
+    def get(self, node_id, names, startup, fetch):
+        entry = self._nodes.get(node_id)
+        if (entry is not None and startup is not None and entry['startup'] == startup and
+                set(names) <= set(entry['names'])):
+            return entry['values']
+
+        values = dict((k, decode(v)) for (k, v) in fetch(names).items())
+        self._nodes[node_id] = {'startup': startup,
+                                'names': sorted(names),
+                                'values': values}
+
+        return values
+
+    def save(self):
+        save_state(self.path, self._nodes)
+
+def get_startup(metrics):
+    if STARTUP in metrics:
+        return metrics[STARTUP]['value']
+    return None
@@ -13,7 +13,8 @@ setup(
     name = "qdb-cloudwatch",
     packages = ["qdb_cloudwatch"],
     entry_points = {
-        "console_scripts": ['qdb-cloudwatch = qdb_cloudwatch.exporter:main']
+        "console_scripts": ['qdb-cloudwatch = qdb_cloudwatch.exporter:main',
+                            'qdb-cloudwatch-ring = qdb_cloudwatch.ringbuffer:main']
         },
     version = version,
     description = "Command line utility to export QuasarDB metrics.",
@@ -21,6 +22,7 @@ setup(
     install_requires=[
         "boto3 >= 1.9",
         "requests",
-        "quasardb >= 3.3.1"],
+        "quasardb >= 3.3.1",
+        "numpy"],
 
     )